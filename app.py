@@ -1,11 +1,18 @@
 from flask import (
     Flask,
+    Response,
+    stream_with_context,
     render_template,
     request,
     redirect,
     url_for,
+    abort,
     flash,
     session,
+    g,
+    has_request_context,
+    before_render_template,
+    template_rendered,
 )
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import (
@@ -17,23 +24,130 @@ from flask_login import (
     UserMixin,
 )
 from werkzeug.security import generate_password_hash, check_password_hash
+import bisect
+import click
 from functools import wraps
+from collections import Counter, OrderedDict, deque, namedtuple
+import csv
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import math
 import os
+import pickle
+import queue
+import random
 import re
-from datetime import datetime
+import sqlite3
+import threading
+import time
+import traceback
+import unicodedata
+from datetime import date, datetime, timedelta
 
 app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///crm.db"
+database_url = os.environ.get("DATABASE_URL", "sqlite:///crm.db")
+if database_url.startswith("postgres://"):
+    database_url = "postgresql://" + database_url[len("postgres://"):]
+app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+if not database_url.startswith("sqlite"):
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": int(os.environ.get("CRM_DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.environ.get("CRM_DB_MAX_OVERFLOW", 10)),
+        "pool_pre_ping": os.environ.get("CRM_DB_POOL_PRE_PING", "1") == "1",
+        "pool_recycle": int(os.environ.get("CRM_DB_POOL_RECYCLE", 1800)),
+    }
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# Applied to every new SQLite connection; CRM_SQLITE_TUNING=0 keeps SQLite's
+# defaults (rollback journal, no mmap).
+app.config["SQLITE_PRAGMAS"] = (
+    {
+        # busy_timeout goes first so the remaining pragmas wait out locks.
+        "busy_timeout": int(os.environ.get("CRM_SQLITE_BUSY_TIMEOUT", 5000)),
+        "journal_mode": os.environ.get("CRM_SQLITE_JOURNAL_MODE", "WAL"),
+        "synchronous": os.environ.get("CRM_SQLITE_SYNCHRONOUS", "NORMAL"),
+        "mmap_size": int(os.environ.get("CRM_SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+        "cache_size": int(os.environ.get("CRM_SQLITE_CACHE_SIZE", -64000)),
+        "temp_store": os.environ.get("CRM_SQLITE_TEMP_STORE", "MEMORY"),
+    }
+    if os.environ.get("CRM_SQLITE_TUNING", "1") == "1"
+    else {}
+)
+app.config["SQLITE_MAINTENANCE_INTERVAL"] = int(
+    os.environ.get("CRM_SQLITE_MAINTENANCE_INTERVAL", 300)
+)
 app.config["SECRET_KEY"] = "dev-secret"
+app.config["PAGE_SIZE"] = int(os.environ.get("CRM_PAGE_SIZE", 50))
+app.config["MAX_PAGE_SIZE"] = int(os.environ.get("CRM_MAX_PAGE_SIZE", 500))
+app.config["SEARCH_RESULT_LIMIT"] = int(os.environ.get("CRM_SEARCH_RESULT_LIMIT", 20))
+app.config["MESSAGE_PAGE_SIZE"] = int(os.environ.get("CRM_MESSAGE_PAGE_SIZE", 20))
+app.config["IMPORT_BATCH_SIZE"] = int(os.environ.get("CRM_IMPORT_BATCH_SIZE", 1000))
+app.config["EXPORT_CHUNK_SIZE"] = int(os.environ.get("CRM_EXPORT_CHUNK_SIZE", 1000))
+# memory:// keeps an LRU cache per process; a redis:// URL shares one cache
+# (and its invalidations) between workers.
+app.config["CACHE_URL"] = os.environ.get("CRM_CACHE_URL", "memory://")
+app.config["CACHE_TTL"] = int(os.environ.get("CRM_CACHE_TTL", 300))
+app.config["CACHE_MAX_ENTRIES"] = int(os.environ.get("CRM_CACHE_MAX_ENTRIES", 1024))
+# memory:// delivers live events to the streams of the same process; a
+# redis:// URL relays them through Redis pub/sub to every worker.
+app.config["EVENTS_URL"] = os.environ.get("CRM_EVENTS_URL", "memory://")
+app.config["EVENTS_HEARTBEAT"] = float(os.environ.get("CRM_EVENTS_HEARTBEAT", 15))
+# Signed-in users are authenticated from a per-process copy of their row for
+# up to this many seconds; 0 loads the row on every request.
+app.config["USER_CACHE_TTL"] = int(os.environ.get("CRM_USER_CACHE_TTL", 60))
+app.config["USER_CACHE_SIZE"] = int(os.environ.get("CRM_USER_CACHE_SIZE", 10000))
+# "thread" runs background jobs on worker threads in every web process;
+# "worker" leaves them to separate ``flask run-jobs`` processes.
+app.config["JOB_RUNNER"] = os.environ.get("CRM_JOB_RUNNER", "thread")
+app.config["JOB_WORKERS"] = int(os.environ.get("CRM_JOB_WORKERS", 2))
+app.config["JOB_MAX_ATTEMPTS"] = int(os.environ.get("CRM_JOB_MAX_ATTEMPTS", 5))
+# Seconds before the first retry of a failed job; doubled for each retry.
+app.config["JOB_RETRY_DELAY"] = float(os.environ.get("CRM_JOB_RETRY_DELAY", 10))
+app.config["JOB_POLL_INTERVAL"] = float(os.environ.get("CRM_JOB_POLL_INTERVAL", 5))
+# Running jobs without a heartbeat for this long are assumed lost with their
+# worker and requeued.
+app.config["JOB_STALE_AFTER"] = int(os.environ.get("CRM_JOB_STALE_AFTER", 900))
+app.config["JOB_RETENTION_DAYS"] = int(os.environ.get("CRM_JOB_RETENTION_DAYS", 7))
+# "inline" notifies mentioned users while posting a message; "job" queues the
+# fan-out as a background job.
+app.config["NOTIFICATION_FANOUT"] = os.environ.get("CRM_NOTIFICATION_FANOUT", "inline")
+# Compiled translation catalogs; locales/*.yml are the sources.
+app.config["TRANSLATIONS_DIR"] = os.environ.get(
+    "CRM_TRANSLATIONS_DIR", os.path.join(app.instance_path, "translations")
+)
+# Seconds between checks for edited locale files (0 disables hot reload).
+app.config["TRANSLATIONS_RELOAD_INTERVAL"] = float(
+    os.environ.get("CRM_TRANSLATIONS_RELOAD_INTERVAL", 2)
+)
+app.config["LOOKUP_PAGE_SIZE"] = int(os.environ.get("CRM_LOOKUP_PAGE_SIZE", 10))
+app.config["DASHBOARD_CACHE_TTL"] = int(os.environ.get("CRM_DASHBOARD_CACHE_TTL", 30))
+app.config["DASHBOARD_WIDGET_SIZE"] = int(os.environ.get("CRM_DASHBOARD_WIDGET_SIZE", 10))
+app.config["CLOSED_TASK_STATUSES"] = ("Closed",)
+app.config["CLOSED_DEAL_STAGES"] = ("Won", "Lost")
+# Deal amounts and quote totals are stored in this currency.
+app.config["BASE_CURRENCY"] = os.environ.get("CRM_BASE_CURRENCY", "USD")
+app.config["PRICING_MAX_LINES"] = int(os.environ.get("CRM_PRICING_MAX_LINES", 1000))
+app.config["KANBAN_COLUMN_SIZE"] = int(os.environ.get("CRM_KANBAN_COLUMN_SIZE", 25))
+# Fail requests that issue more SQL statements than this (0 disables).
+app.config["SQL_STATEMENT_LIMIT"] = int(os.environ.get("CRM_SQL_STATEMENT_LIMIT", 0))
+# Fraction of requests to profile (0 disables, 1 profiles every request).
+app.config["PROFILE_SAMPLE_RATE"] = float(os.environ.get("CRM_PROFILE_SAMPLE_RATE", 0))
+# Set at startup once the FTS5 search index is known to be available.
+app.config["SEARCH_FTS"] = False
 db = SQLAlchemy(app)
 
 login_manager = LoginManager(app)
 login_manager.login_view = "login"
 
 # --- Translation handling -------------------------------------------------
-translations_cache = {}
 AVAILABLE_LANGS = ["en", "de"]
+LOCALES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "locales")
+# ``stamp`` is the source file's mtime, or None when the language has no file.
+Catalog = namedtuple("Catalog", "messages stamp")
+translation_catalogs = {}  # lang -> Catalog
+translation_checks = {}  # lang -> monotonic time of the last freshness check
 
 
 def _parse_simple_yaml(path):
@@ -52,32 +166,101 @@ def _parse_simple_yaml(path):
     return data
 
 
+def _catalog_stamp(lang):
+    try:
+        return os.path.getmtime(os.path.join(LOCALES_DIR, f"{lang}.yml"))
+    except OSError:
+        return None
+
+
+def compile_catalog(lang):
+    """Parse ``locales/<lang>.yml`` and store it as a pickled catalog."""
+    stamp = _catalog_stamp(lang)
+    catalog = Catalog(_parse_simple_yaml(os.path.join(LOCALES_DIR, f"{lang}.yml")), stamp)
+    if stamp is None:
+        return catalog
+    path = os.path.join(app.config["TRANSLATIONS_DIR"], f"{lang}.pickle")
+    try:
+        os.makedirs(app.config["TRANSLATIONS_DIR"], exist_ok=True)
+        # Written under a temporary name and renamed, so other workers never
+        # read a half-written file.
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(tuple(catalog), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError:
+        app.logger.warning("Could not write compiled translations to %s", path)
+    return catalog
+
+
+def load_catalog(lang):
+    """Load the compiled catalog for ``lang``, recompiling it if stale."""
+    stamp = _catalog_stamp(lang)
+    path = os.path.join(app.config["TRANSLATIONS_DIR"], f"{lang}.pickle")
+    try:
+        with open(path, "rb") as f:
+            catalog = Catalog(*pickle.load(f))
+        if catalog.stamp == stamp:
+            return catalog
+    except (OSError, EOFError, TypeError, pickle.UnpicklingError):
+        pass
+    return compile_catalog(lang)
+
+
+def get_catalog(lang):
+    """Return the catalog for ``lang``, reloading it when its file changed.
+
+    The file is stat'ed at most once per TRANSLATIONS_RELOAD_INTERVAL.
+    Catalogs loaded at startup are shared copy-on-write by forked workers.
+    """
+    catalog = translation_catalogs.get(lang)
+    interval = app.config["TRANSLATIONS_RELOAD_INTERVAL"]
+    now = time.monotonic()
+    if catalog is None or (interval and now - translation_checks.get(lang, 0) >= interval):
+        translation_checks[lang] = now
+        if catalog is None or _catalog_stamp(lang) != catalog.stamp:
+            catalog = translation_catalogs[lang] = load_catalog(lang)
+    return catalog
+
+
+def current_language():
+    if current_user.is_authenticated:
+        return current_user.language
+    return session.get("lang", "en")
+
+
+def current_catalog():
+    """Return the current user's catalog, looked up once per request."""
+    if "catalog" not in g:
+        g.catalog = get_catalog(current_language())
+    return g.catalog
+
+
 def get_translations():
-    lang = (
-        current_user.language
-        if current_user.is_authenticated
-        else session.get("lang", "en")
-    )
-    if lang not in translations_cache:
-        fname = os.path.join(os.path.dirname(__file__), "locales", f"{lang}.yml")
-        translations_cache[lang] = _parse_simple_yaml(fname)
-    return translations_cache[lang]
+    return current_catalog().messages
 
 
 @app.context_processor
 def inject_translator():
-    t = get_translations()
+    if "translate" not in g:
+        messages = get_translations()
+        g.translate = lambda key: messages.get(key, key)
+    return {"_": g.translate}
 
-    def _(key):
-        return t.get(key, key)
 
-    return {"_": _}
+@app.cli.command("compile-translations")
+def compile_translations_command():
+    """Compile locales/*.yml into the catalogs the app loads."""
+    for name in sorted(os.listdir(LOCALES_DIR)):
+        if name.endswith(".yml"):
+            lang = name[: -len(".yml")]
+            click.echo(f"{lang}: {len(compile_catalog(lang).messages)} messages")
 
 
 @app.context_processor
 def inject_notification_count():
     if current_user.is_authenticated:
-        count = Notification.query.filter_by(user_id=current_user.id, is_read=False).count()
+        count = current_user.unread_notifications or 0
     else:
         count = 0
     return {"unread_notifications": count}
@@ -85,7 +268,7 @@ def inject_notification_count():
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return cached_identity(int(user_id))
 
 
 class User(UserMixin, db.Model):
@@ -93,18 +276,35 @@ class User(UserMixin, db.Model):
     username = db.Column(db.String(80), unique=True, nullable=False)
     password_hash = db.Column(db.String(128))
     is_admin = db.Column(db.Boolean, default=False)
-    language = db.Column(db.String(10), default="en")
-    timezone = db.Column(db.String(50), default="UTC")
+    language = db.Column(db.String(10), default="en", server_default="en")
+    timezone = db.Column(db.String(50), default="UTC", server_default="UTC")
     country = db.Column(db.String(50))
-    currency = db.Column(db.String(3), default="USD")
+    currency = db.Column(db.String(3), default="USD", server_default="USD")
+    # Denormalized count of unread notifications, kept in step by the views
+    # that create and read notifications.
+    unread_notifications = db.Column(db.Integer, default=0, server_default="0")
 
 
 class StatusOption(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    model = db.Column(db.String(50))
+    model = db.Column(db.String(50), index=True)
     value = db.Column(db.String(50))
 
 
+def fold_name(value):
+    """Return ``value`` normalised for case-insensitive prefix matching."""
+    return unicodedata.normalize("NFKC", value).casefold() if value is not None else None
+
+
+def name_key_column():
+    # Folded copy of ``name`` that record pickers match and sort on. It is
+    # computed in Python so typed prefixes fold the same way on every
+    # database; the default covers Core inserts, which skip attribute events.
+    return db.Column(
+        db.Text, default=lambda ctx: fold_name(ctx.get_current_parameters().get("name"))
+    )
+
+
 class Lead(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
@@ -112,12 +312,13 @@ class Lead(db.Model):
     phone = db.Column(db.String(50))
     company = db.Column(db.String(120))
     notes = db.Column(db.Text)
-    status = db.Column(db.String(50))
+    status = db.Column(db.String(50), index=True)
 
 
 class Account(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
+    name_key = name_key_column()
     industry = db.Column(db.String(120))
     email = db.Column(db.String(120))
     phone = db.Column(db.String(50))
@@ -131,23 +332,27 @@ class Contact(db.Model):
     email = db.Column(db.String(120))
     phone = db.Column(db.String(50))
     title = db.Column(db.String(120))
-    account_id = db.Column(db.Integer, db.ForeignKey("account.id"))
+    account_id = db.Column(db.Integer, db.ForeignKey("account.id"), index=True)
     account = db.relationship("Account", backref=db.backref("contacts", lazy=True))
 
 
 class Deal(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
+    name_key = name_key_column()
     amount = db.Column(db.Float)
-    stage = db.Column(db.String(50))
+    stage = db.Column(db.String(50), index=True)
     close_date = db.Column(db.String(50))
-    account_id = db.Column(db.Integer, db.ForeignKey("account.id"))
+    account_id = db.Column(db.Integer, db.ForeignKey("account.id"), index=True)
     account = db.relationship("Account", backref=db.backref("deals", lazy=True))
+    # amount in the viewer's currency, when loaded with with_converted(Deal)
+    converted = db.query_expression()
 
 
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
+    name_key = name_key_column()
     price = db.Column(db.Float)
     description = db.Column(db.Text)
 
@@ -155,83 +360,2377 @@ class Product(db.Model):
 class Pricebook(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
+    name_key = name_key_column()
     description = db.Column(db.Text)
 
 
 class PriceBookEntry(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    product_id = db.Column(db.Integer, db.ForeignKey("product.id"))
+    product_id = db.Column(db.Integer, db.ForeignKey("product.id"), index=True)
     pricebook_id = db.Column(db.Integer, db.ForeignKey("pricebook.id"))
     unit_price = db.Column(db.Float)
     product = db.relationship("Product")
     pricebook = db.relationship("Pricebook")
 
 
-class Quote(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    deal_id = db.Column(db.Integer, db.ForeignKey("deal.id"))
-    total = db.Column(db.Float)
-    expiration_date = db.Column(db.String(50))
-    deal = db.relationship("Deal")
+class Quote(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    deal_id = db.Column(db.Integer, db.ForeignKey("deal.id"))
+    total = db.Column(db.Float)
+    expiration_date = db.Column(db.String(50))
+    deal = db.relationship("Deal")
+    # total in the viewer's currency, when loaded with with_converted(Quote)
+    converted = db.query_expression()
+
+
+class ExchangeRate(db.Model):
+    """Units of ``currency`` per one BASE_CURRENCY from ``effective_date`` on."""
+
+    __table_args__ = (db.UniqueConstraint("currency", "effective_date"),)
+    id = db.Column(db.Integer, primary_key=True)
+    currency = db.Column(db.String(3), nullable=False)
+    rate = db.Column(db.Float, nullable=False)
+    effective_date = db.Column(db.Date, nullable=False)
+
+
+class QuoteLineItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    # active_history keeps the previous values of the columns that feed
+    # Quote.total, even when they were not loaded before being changed.
+    quote_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey("quote.id"), index=True), active_history=True
+    )
+    product_id = db.Column(db.Integer, db.ForeignKey("product.id"))
+    quantity = db.column_property(db.Column(db.Integer), active_history=True)
+    price = db.column_property(db.Column(db.Float), active_history=True)
+    quote = db.relationship("Quote", backref=db.backref("line_items", lazy=True))
+    product = db.relationship("Product")
+
+
+class Task(db.Model):
+    __table_args__ = (db.Index("ix_task_record", "model", "record_id"),)
+    id = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String(255))
+    due_date = db.Column(db.String(50))
+    status = db.Column(db.String(50), index=True)
+    model = db.Column(db.String(50))
+    record_id = db.Column(db.Integer)
+
+
+class Message(db.Model):
+    __table_args__ = (
+        # id, not created_at: threads are listed and paged by message id.
+        db.Index("ix_message_thread", "model", "record_id", "id"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    model = db.Column(db.String(50))
+    record_id = db.Column(db.Integer)
+    content = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # False while the message's mention notifications are still queued.
+    notified = db.Column(db.Boolean, default=True, server_default=db.true(), index=True)
+    user = db.relationship("User")
+
+
+class Notification(db.Model):
+    __table_args__ = (
+        db.Index("ix_notification_user", "user_id", "is_read", "created_at"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    message_id = db.Column(db.Integer, db.ForeignKey("message.id"))
+    model = db.Column(db.String(50))
+    record_id = db.Column(db.Integer)
+    is_read = db.Column(db.Boolean, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    user = db.relationship("User")
+    message = db.relationship("Message")
+
+
+class ImportRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50))
+    filename = db.Column(db.String(255))
+    format = db.Column(db.String(10))
+    status = db.Column(db.String(20), default="running")
+    rows_done = db.Column(db.Integer, default=0)
+    inserted = db.Column(db.Integer, default=0)
+    failed = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class ImportRowError(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.Integer, db.ForeignKey("import_run.id"), index=True)
+    row = db.Column(db.Integer)
+    message = db.Column(db.String(255))
+
+
+class Job(db.Model):
+    __table_args__ = (db.Index("ix_job_queue", "status", "run_at"),)
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, default="{}")
+    status = db.Column(db.String(20), default="queued")
+    attempts = db.Column(db.Integer, default=0)
+    max_attempts = db.Column(db.Integer, default=5)
+    run_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    # Renewed by long handlers while they make progress; see job_heartbeat.
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    error = db.Column(db.Text)
+
+
+# --- Caching --------------------------------------------------------------
+class MemoryCache:
+    """In-process LRU cache whose entries also expire after their TTL."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (expires at, value)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return (entry[1],)
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class RedisCache:
+    """Cache kept in a Redis server so every worker shares its entries."""
+
+    def __init__(self, url):
+        import redis  # optional dependency, only needed for redis:// URLs
+
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        raw = self.client.get(f"crm:{key}")
+        return None if raw is None else (pickle.loads(raw),)
+
+    def set(self, key, value, ttl):
+        self.client.set(f"crm:{key}", pickle.dumps(value), ex=ttl)
+
+
+class Cache:
+    """Cache front end with table invalidation and per-name hit/miss counters.
+
+    An entry's tags are the tables it was computed from. Keys embed their
+    committed table_version counters, so a write in any worker leaves every
+    entry computed before it unreachable, and an entry always matches the
+    ETag built from the same versions.
+    """
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self.stats = {}  # name -> [hits, misses]
+        self.lock = threading.Lock()
+
+    def cached(self, name, compute, tags=(), key="", ttl=None):
+        versions = [version for _, version in table_versions(tags)] if tags else []
+        full_key = ":".join([name, key, *map(str, versions)])
+        entry = self.backend.get(full_key)
+        with self.lock:
+            self.stats.setdefault(name, [0, 0])[0 if entry is not None else 1] += 1
+        if entry is not None:
+            return entry[0]
+        value = compute()
+        self.backend.set(full_key, value, ttl or self.ttl)
+        return value
+
+
+def create_cache(url):
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        backend = RedisCache(url)
+    else:
+        backend = MemoryCache(app.config["CACHE_MAX_ENTRIES"])
+    return Cache(backend, app.config["CACHE_TTL"])
+
+
+cache = create_cache(app.config["CACHE_URL"])
+
+
+@db.event.listens_for(db.session, "after_flush")
+def collect_written_tables(session, flush_context):
+    record_table_writes(
+        session,
+        {obj.__table__.name for obj in itertools.chain(session.new, session.dirty, session.deleted)},
+    )
+
+
+@db.event.listens_for(db.session, "after_rollback")
+def discard_written_tables(session):
+    session.info.pop("written_tables", None)
+
+
+StatusChoice = namedtuple("StatusChoice", "id value")
+
+
+def status_options(model):
+    """Return the cached status choices configured for ``model``."""
+    return cache.cached(
+        "status_options",
+        lambda: [
+            StatusChoice(s.id, s.value)
+            for s in StatusOption.query.filter_by(model=model).order_by(StatusOption.id)
+        ],
+        tags=[StatusOption.__table__.name],
+        key=model,
+    )
+
+
+# --- User identities ------------------------------------------------------
+# load_user runs on every request. It returns a snapshot of the fields that
+# requests read, kept per process for USER_CACHE_TTL seconds, so most
+# requests authenticate without touching the database. Views that change a
+# user call forget_identity, and changes to the unread notification count
+# forget the snapshot when they commit; other workers catch up within the TTL.
+class UserIdentity(UserMixin):
+    """Detached copy of a User, safe to share between requests and threads."""
+
+    FIELDS = (
+        "id", "username", "is_admin", "language", "timezone", "currency",
+        "unread_notifications",
+    )
+
+    def __init__(self, user):
+        for field in self.FIELDS:
+            setattr(self, field, getattr(user, field))
+
+
+user_identities = MemoryCache(app.config["USER_CACHE_SIZE"])
+
+
+def cached_identity(user_id):
+    ttl = app.config["USER_CACHE_TTL"]
+    if not ttl:
+        return db.session.get(User, user_id)
+    hit = user_identities.get(user_id)
+    if hit:
+        return hit[0]
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    identity = UserIdentity(user)
+    user_identities.set(user_id, identity, ttl)
+    return identity
+
+
+def forget_identity(user_id):
+    user_identities.delete(user_id)
+
+
+def forget_identities_on_commit(session, user_ids):
+    session.info.setdefault("stale_identities", set()).update(user_ids)
+
+
+@db.event.listens_for(db.session, "after_commit")
+def forget_stale_identities(session):
+    for user_id in session.info.pop("stale_identities", ()):
+        forget_identity(user_id)
+
+
+@db.event.listens_for(db.session, "after_rollback")
+def discard_stale_identities(session):
+    session.info.pop("stale_identities", None)
+
+
+# --- Live events ----------------------------------------------------------
+# Committed changes that other viewers should see at once are pushed to their
+# browsers over server-sent events. Views queue events on the session; they
+# are published only when the transaction commits.
+EVENT_QUEUE_SIZE = 256
+
+
+class EventHub:
+    """Hands published events to the event streams open in this process."""
+
+    def __init__(self):
+        self.subscribers = {}  # queue -> user id
+        self.lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        q = queue.Queue(EVENT_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers[q] = user_id
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.pop(q, None)
+
+    def dispatch(self, event):
+        with self.lock:
+            targets = [
+                q for q, user_id in self.subscribers.items()
+                if event["user_id"] in (None, user_id)
+            ]
+        for q in targets:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                pass  # a stalled client misses events rather than growing memory
+
+
+class LocalBroker:
+    """Broker stand-in for a single process: publishing is dispatching."""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def publish(self, events):
+        for event in events:
+            self.hub.dispatch(event)
+
+    def listen(self):
+        pass
+
+
+class RedisBroker:
+    """Relays events through Redis pub/sub so every worker's streams see them."""
+
+    channel = "crm:events"
+
+    def __init__(self, url, hub):
+        import redis  # optional dependency, only needed for redis:// URLs
+
+        self.client = redis.Redis.from_url(url)
+        self.hub = hub
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def publish(self, events):
+        pipe = self.client.pipeline(transaction=False)
+        for event in events:
+            pipe.publish(self.channel, json.dumps(event))
+        pipe.execute()
+
+    def listen(self):
+        """Start relaying to this process's hub, once it has a subscriber."""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.relay, daemon=True)
+                self.thread.start()
+
+    def relay(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    self.hub.dispatch(json.loads(message["data"]))
+            except Exception:
+                app.logger.exception("Event relay lost its Redis connection")
+                time.sleep(1)
+
+
+def create_event_broker(url):
+    hub = EventHub()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBroker(url, hub)
+    return LocalBroker(hub)
+
+
+event_broker = create_event_broker(app.config["EVENTS_URL"])
+
+
+def queue_event(session, kind, data, user_id=None):
+    """Publish ``data`` as a ``kind`` event when ``session`` commits.
+
+    Events go to every signed-in viewer, or only to ``user_id``'s streams.
+    """
+    session.info.setdefault("events", []).append(
+        {"type": kind, "data": data, "user_id": user_id}
+    )
+
+
+@db.event.listens_for(db.session, "after_commit")
+def publish_events(session):
+    events = session.info.pop("events", None)
+    if events:
+        try:
+            event_broker.publish(events)
+        except Exception:
+            # The data is committed; viewers catch up on their next page load.
+            app.logger.exception("Could not publish %d live event(s)", len(events))
+
+
+@db.event.listens_for(db.session, "after_rollback")
+def discard_events(session):
+    session.info.pop("events", None)
+
+
+def event_stream(q):
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                event = q.get(timeout=app.config["EVENTS_HEARTBEAT"])
+            except queue.Empty:
+                # Comments keep proxies from closing an idle connection.
+                yield ": keepalive\n\n"
+                continue
+            yield f"event: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+    finally:
+        event_broker.hub.unsubscribe(q)
+
+
+# --- Conditional requests --------------------------------------------------
+# Pages and JSON responses carry strong ETags built from per-table version
+# counters. A transaction bumps the counters of the tables it wrote just
+# before it commits, so a client's ETag only matches while nothing it was
+# built from changed.
+table_version = db.Table(
+    "table_version",
+    db.metadata,
+    db.Column("name", db.String(64), primary_key=True),
+    db.Column("version", db.Integer, nullable=False, default=0),
+)
+# Tables whose writes never show up in a conditional response.
+UNVERSIONED_TABLES = {"job", "schema_version", "table_version"}
+
+
+def record_table_writes(session, tables):
+    """Note that the current transaction of ``session`` wrote ``tables``.
+
+    Called from the flush hook for ORM writes; bulk statements that bypass
+    the flush call it directly. The versions are bumped at commit.
+    """
+    tables = set(tables) - UNVERSIONED_TABLES
+    if tables:
+        session.info.setdefault("written_tables", set()).update(tables)
+
+
+@db.event.listens_for(db.session, "before_commit")
+def bump_table_versions(session):
+    # Commit runs its last flush after this hook; run it now so its writes
+    # are counted too.
+    session.flush()
+    tables = session.info.pop("written_tables", None)
+    if tables:
+        # One UPDATE at the end of the transaction holds the version rows'
+        # locks only while committing, and always takes them in name order,
+        # so concurrent writers cannot deadlock on them.
+        session.connection().execute(
+            db.update(table_version)
+            .where(table_version.c.name.in_(sorted(tables)))
+            .values(version=table_version.c.version + 1)
+        )
+
+
+def table_versions(tables):
+    """Return the committed ``(name, version)`` rows of ``tables`` by name."""
+    return db.session.execute(
+        db.select(table_version.c.name, table_version.c.version)
+        .where(table_version.c.name.in_(sorted(set(tables))))
+        .order_by(table_version.c.name)
+    ).all()
+
+
+def ensure_table_versions():
+    """Create the version rows for tables that do not have one yet."""
+    existing = set(db.session.scalars(db.select(table_version.c.name)))
+    missing = {t.name for t in db.metadata.sorted_tables} - UNVERSIONED_TABLES - existing
+    if missing:
+        db.session.execute(
+            db.insert(table_version), [{"name": n, "version": 0} for n in sorted(missing)]
+        )
+    db.session.commit()
+
+
+class TableSnapshot:
+    """Per-process data loaded from ``tables``, reloaded when they change.
+
+    ``get()`` costs one version lookup; ``load()`` runs again only after a
+    write to one of the tables, in this process or any other.
+    """
+
+    def __init__(self, tables, load):
+        self.tables = sorted(tables)
+        self.load = load
+        self.snapshot = (None, None)
+        self.lock = threading.Lock()
+
+    def get(self):
+        version = tuple(table_versions(self.tables))
+        if self.snapshot[0] != version:
+            with self.lock:
+                if self.snapshot[0] != version:
+                    # Loaded after the version was read, so a concurrent
+                    # write can only make the data newer than its version.
+                    self.snapshot = (version, self.load())
+        return self.snapshot[1]
+
+
+def _build_id():
+    """Hash the code and templates, so a deploy changes ETags."""
+    digest = hashlib.sha1()
+    root = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(os.path.join(root, "templates"))):
+        with open(os.path.join(root, "templates", name), "rb") as f:
+            digest.update(f.read())
+    with open(os.path.join(root, "app.py"), "rb") as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+BUILD_ID = _build_id()
+
+
+def not_modified(*tables):
+    """Return a 304 response if the client's copy of this GET is current.
+
+    Otherwise the ETag is remembered for the response and None is returned,
+    so views call ``return not_modified(...) or render(...)``. The ETag
+    covers the URL, the viewer's own state shown on every page and the
+    versions of ``tables``.
+    """
+    if request.method != "GET" or session.get("_flashes"):
+        return None
+    versions = table_versions(tables)
+    viewer = (
+        (
+            current_user.id,
+            current_user.unread_notifications,
+            current_user.language,
+            current_user.timezone,
+            current_user.currency,
+            current_rate_date(),
+        )
+        if current_user.is_authenticated
+        else session.get("lang")
+    )
+    # The catalog stamp changes when a locale file is edited and hot-reloaded.
+    key = repr((BUILD_ID, request.full_path, viewer, current_catalog().stamp, versions))
+    g.etag = hashlib.sha1(key.encode()).hexdigest()
+    if request.if_none_match.contains(g.etag):
+        response = Response(status=304)
+        response.set_etag(g.etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
+    return None
+
+
+def conditional(*tables):
+    """Decorate a GET view whose output depends only on ``tables``."""
+
+    def decorate(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            return not_modified(*tables) or view(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def record_tables(model):
+    """Return ``model``'s table and the tables of the records it points to."""
+    return [model.__tablename__] + [
+        r.mapper.local_table.name
+        for r in db.inspect(model).relationships
+        if r.direction is db.MANYTOONE
+    ]
+
+
+static_hashes = {}  # filename -> (mtime, content hash)
+
+
+def static_hash(filename):
+    path = os.path.join(app.static_folder, filename)
+    mtime = os.path.getmtime(path)
+    cached = static_hashes.get(filename)
+    if cached is None or cached[0] != mtime:
+        with open(path, "rb") as f:
+            cached = (mtime, hashlib.sha1(f.read()).hexdigest()[:12])
+        static_hashes[filename] = cached
+    return cached[1]
+
+
+@app.url_defaults
+def add_static_hash(endpoint, values):
+    # Static URLs carry their content hash, so they can be cached for good:
+    # a changed file gets a new URL.
+    if endpoint == "static" and "filename" in values:
+        try:
+            values["v"] = static_hash(values["filename"])
+        except OSError:
+            pass
+
+
+@app.after_request
+def set_cache_headers(response):
+    if request.endpoint == "static":
+        try:
+            current = request.args.get("v") == static_hash(request.view_args["filename"])
+        except OSError:
+            current = False
+        if current and response.status_code in (200, 304):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    elif g.get("etag") and response.status_code == 200:
+        response.set_etag(g.etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+# --- Typeahead lookups -----------------------------------------------------
+# Record pickers fetch matches from /api/lookup/<table> instead of embedding
+# every row in the form. Named records are matched on a prefix of their folded
+# name, which range-scans these indexes.
+LOOKUP_SOURCES = {
+    model.__tablename__: model for model in (Account, Deal, Product, Pricebook, Quote)
+}
+
+
+def update_name_key(target, value, oldvalue, initiator):
+    target.name_key = fold_name(value)
+
+
+for _model in LOOKUP_SOURCES.values():
+    if hasattr(_model, "name_key"):
+        db.Index(f"ix_{_model.__tablename__}_name_key", _model.name_key, _model.id)
+        db.event.listen(_model.name, "set", update_name_key)
+
+
+@app.template_global()
+def lookup_label(table, record_id):
+    """Return the text a picker shows for ``record_id``."""
+    model = LOOKUP_SOURCES[table]
+    if not hasattr(model, "name"):
+        return f"{model.__name__} {record_id}" if record_id else ""
+    record = db.session.get(model, record_id) if record_id else None
+    return record.name if record else ""
+
+
+def lookup_records(table, q, after=None, limit=None):
+    """Return one page of picker matches and the cursor of the next page.
+
+    Named records are ordered by name and matched on its prefix; records
+    without a name (quotes) are listed by id, and a numeric ``q`` selects
+    that id.
+    """
+    model = LOOKUP_SOURCES[table]
+    limit = max(1, min(limit or app.config["LOOKUP_PAGE_SIZE"], 50))
+    if hasattr(model, "name_key"):
+        key = model.name_key
+        query = db.select(model.id, model.name).order_by(key, model.id)
+        if q:
+            prefix = fold_name(q)
+            query = query.where(key >= prefix, key < prefix + "\U0010ffff")
+        if after is not None:
+            last = db.select(key).where(model.id == after).scalar_subquery()
+            query = query.where(db.tuple_(key, model.id) > db.tuple_(last, after))
+    else:
+        query = db.select(model.id, db.null()).order_by(model.id)
+        if q:
+            query = query.where(model.id == (int(q) if q.isdigit() else None))
+        if after is not None:
+            query = query.where(model.id > after)
+    rows = db.session.execute(query.limit(limit + 1)).all()
+    results = [
+        {"id": id_, "label": name if name is not None else f"{model.__name__} {id_}"}
+        for id_, name in rows[:limit]
+    ]
+    next_cursor = results[-1]["id"] if len(rows) > limit else None
+    return results, next_cursor
+
+
+# --- Relationship loading -------------------------------------------------
+# Relationships read by each view's template, loaded together with the rows
+# instead of through one lazy SELECT per row.
+VIEW_LOADERS = {
+    "list_quotes": [db.joinedload(Quote.deal)],
+    "list_quote_line_items": [db.joinedload(QuoteLineItem.product)],
+    "list_pricebook_entries": [
+        db.joinedload(PriceBookEntry.product),
+        db.joinedload(PriceBookEntry.pricebook),
+    ],
+    "list_notifications": [
+        db.joinedload(Notification.message).joinedload(Message.user)
+    ],
+    "show_contact": [db.joinedload(Contact.account)],
+    "show_deal": [db.joinedload(Deal.account)],
+    "show_quote": [db.joinedload(Quote.deal)],
+    "show_quote_line_item": [db.joinedload(QuoteLineItem.product)],
+    "show_pricebook_entry": [
+        db.joinedload(PriceBookEntry.product),
+        db.joinedload(PriceBookEntry.pricebook),
+    ],
+}
+
+
+def view_query(model):
+    """Return ``model.query`` with the current view's declared loaders."""
+    return model.query.options(*VIEW_LOADERS.get(request.endpoint, ()))
+
+
+@db.event.listens_for(db.Engine, "before_cursor_execute")
+def count_sql_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.sql_statements = g.get("sql_statements", 0) + 1
+
+
+@app.after_request
+def enforce_sql_statement_limit(response):
+    limit = app.config["SQL_STATEMENT_LIMIT"]
+    count = g.get("sql_statements", 0)
+    if limit and count > limit:
+        raise RuntimeError(
+            f"{request.endpoint} issued {count} SQL statements (limit {limit})"
+        )
+    return response
+
+
+# --- Request profiling ----------------------------------------------------
+# Per-process timings of sampled requests, shown on the admin profiling page.
+PROFILE_WINDOW = 1000
+SLOW_QUERY_COUNT = 20
+profile_lock = threading.Lock()
+profile_stats = {}  # endpoint -> deque of (total, sql, statements, render)
+slow_queries = []  # min-heap of (seconds, statement, endpoint)
+
+
+@app.before_request
+def start_profile():
+    rate = app.config["PROFILE_SAMPLE_RATE"]
+    if rate and random.random() < rate:
+        g.profile = {"start": time.perf_counter(), "sql": 0.0, "render": 0.0}
+
+
+@db.event.listens_for(db.Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and "profile" in g:
+        conn.info["query_started"] = time.perf_counter()
+
+
+@db.event.listens_for(db.Engine, "after_cursor_execute")
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop("query_started", None)
+    if started is None or not has_request_context() or "profile" not in g:
+        return
+    elapsed = time.perf_counter() - started
+    g.profile["sql"] += elapsed
+    entry = (elapsed, statement[:500], request.endpoint)
+    with profile_lock:
+        if len(slow_queries) < SLOW_QUERY_COUNT:
+            heapq.heappush(slow_queries, entry)
+        elif elapsed > slow_queries[0][0]:
+            heapq.heapreplace(slow_queries, entry)
+
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    if "profile" in g:
+        g.profile["render_started"] = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def stop_render_timer(sender, template, context, **extra):
+    if "profile" in g and "render_started" in g.profile:
+        g.profile["render"] += time.perf_counter() - g.profile.pop("render_started")
+
+
+@app.after_request
+def finish_profile(response):
+    profile = g.pop("profile", None)
+    if profile is None:
+        return response
+    total = time.perf_counter() - profile["start"]
+    statements = g.get("sql_statements", 0)
+    response.headers["Server-Timing"] = (
+        f'sql;dur={profile["sql"] * 1000:.1f};desc="{statements} statements", '
+        f'render;dur={profile["render"] * 1000:.1f}, total;dur={total * 1000:.1f}'
+    )
+    with profile_lock:
+        samples = profile_stats.setdefault(request.endpoint, deque(maxlen=PROFILE_WINDOW))
+        samples.append((total, profile["sql"], statements, profile["render"]))
+    return response
+
+
+def _percentile(values, fraction):
+    return values[round(fraction * (len(values) - 1))]
+
+
+def profile_summary():
+    """Return per-endpoint latency percentiles and averages, slowest first."""
+    with profile_lock:
+        stats = {endpoint: list(samples) for endpoint, samples in profile_stats.items()}
+        queries = sorted(slow_queries, reverse=True)
+    rows = []
+    for endpoint, samples in stats.items():
+        totals = sorted(s[0] for s in samples)
+        n = len(samples)
+        rows.append(
+            {
+                "endpoint": endpoint,
+                "requests": n,
+                "p50": _percentile(totals, 0.5) * 1000,
+                "p95": _percentile(totals, 0.95) * 1000,
+                "p99": _percentile(totals, 0.99) * 1000,
+                "sql_ms": sum(s[1] for s in samples) / n * 1000,
+                "statements": sum(s[2] for s in samples) / n,
+                "render_ms": sum(s[3] for s in samples) / n * 1000,
+            }
+        )
+    rows.sort(key=lambda r: r["p95"], reverse=True)
+    return rows, queries
+
+
+# --- Full-text search -----------------------------------------------------
+# kind -> (model, title column, body columns, attached). Attached records
+# (tasks, messages) link to the record they were created on rather than to
+# a page of their own. Kinds are encoded into the index rowid, so new kinds
+# must be appended at the end.
+SEARCH_SOURCES = {
+    "leads": (Lead, "name", ("email", "company", "notes"), False),
+    "accounts": (Account, "name", ("industry", "email", "notes"), False),
+    "contacts": (Contact, "name", ("email", "title"), False),
+    "deals": (Deal, "name", (), False),
+    "products": (Product, "name", ("description",), False),
+    "pricebooks": (Pricebook, "name", ("description",), False),
+    "tasks": (Task, "description", (), True),
+    "messages": (Message, "content", (), True),
+}
+SEARCH_KINDS = {source[0]: kind for kind, source in SEARCH_SOURCES.items()}
+SEARCH_KIND_IDS = {kind: n for n, kind in enumerate(SEARCH_SOURCES)}
+SEARCH_KIND_SLOTS = 16
+
+search_index = db.table(
+    "search_index",
+    db.column("rowid"),
+    db.column("title"),
+    db.column("body"),
+    db.column("kind"),
+    db.column("model"),
+    db.column("record_id"),
+)
+
+
+def search_rowid(kind, record_id):
+    return record_id * SEARCH_KIND_SLOTS + SEARCH_KIND_IDS[kind]
+
+
+def fts_match(q):
+    """Turn free text into an FTS5 query of quoted prefix terms."""
+    return " ".join(f'"{term}"*' for term in re.findall(r"\w+", q))
+
+
+def _search_row(kind, obj):
+    model, title, body, attached = SEARCH_SOURCES[kind]
+    return {
+        "rowid": search_rowid(kind, obj.id),
+        "title": getattr(obj, title) or "",
+        "body": " ".join(str(getattr(obj, c) or "") for c in body),
+        "kind": kind,
+        "model": obj.model if attached else kind,
+        "record_id": obj.record_id if attached else obj.id,
+    }
+
+
+@db.event.listens_for(db.session, "after_flush")
+def sync_search_index(session, flush_context):
+    if not app.config["SEARCH_FTS"]:
+        return
+    stale, fresh = [], []
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        kind = SEARCH_KINDS.get(type(obj))
+        if kind is None:
+            continue
+        if obj in session.dirty and not session.is_modified(obj):
+            continue
+        if obj not in session.new:
+            stale.append({"rowid": search_rowid(kind, obj.id)})
+        if obj not in session.deleted:
+            fresh.append(_search_row(kind, obj))
+    conn = session.connection()
+    if stale:
+        conn.execute(db.text("DELETE FROM search_index WHERE rowid = :rowid"), stale)
+    if fresh:
+        conn.execute(db.insert(search_index), fresh)
+
+
+def index_search_rows(kind, *criteria):
+    """Index the ``kind`` rows matching ``criteria`` with one INSERT ... SELECT.
+
+    Used for writes that bypass the ORM flush, such as bulk imports.
+    """
+    model, title, body, attached = SEARCH_SOURCES[kind]
+    body_expr = db.literal("")
+    for c in body:
+        body_expr = body_expr + " " + db.func.coalesce(getattr(model, c), "")
+    select = db.select(
+        model.id * SEARCH_KIND_SLOTS + SEARCH_KIND_IDS[kind],
+        db.func.coalesce(getattr(model, title), ""),
+        body_expr,
+        db.literal(kind),
+        model.model if attached else db.literal(kind),
+        model.record_id if attached else model.id,
+    ).where(*criteria)
+    db.session.execute(
+        db.insert(search_index).from_select(
+            ["rowid", "title", "body", "kind", "model", "record_id"], select
+        )
+    )
+
+
+def rebuild_search_index():
+    # One transaction per kind, so a job running this can renew its lease.
+    for kind in SEARCH_SOURCES:
+        db.session.execute(db.text("DELETE FROM search_index WHERE kind = :kind"), {"kind": kind})
+        index_search_rows(kind)
+        job_heartbeat()
+        db.session.commit()
+    db.session.execute(db.text("INSERT INTO search_index(search_index) VALUES ('optimize')"))
+    db.session.commit()
+
+
+@app.cli.command("rebuild-search-index")
+def rebuild_search_index_command():
+    """Rebuild the full-text search index from the current data."""
+    if not app.config["SEARCH_FTS"]:
+        raise click.ClickException("SQLite FTS5 is not available for this database.")
+    rebuild_search_index()
+    click.echo("Search index rebuilt.")
+
+
+def search_filter(query, model, column, q):
+    """Restrict ``query`` to ``model`` rows matching the search text ``q``.
+
+    Uses the FTS index when available and falls back to a substring match
+    on ``column`` otherwise.
+    """
+    match = fts_match(q)
+    if not app.config["SEARCH_FTS"] or not match:
+        return query.filter(column.ilike(f"%{q}%"))
+    ids = (
+        db.text(
+            "SELECT rowid / :slots AS id FROM search_index"
+            " WHERE search_index MATCH :match AND kind = :kind"
+        )
+        .bindparams(slots=SEARCH_KIND_SLOTS, match=match, kind=SEARCH_KINDS[model])
+        .columns(db.column("id", db.Integer))
+    )
+    return query.filter(model.id.in_(ids))
+
+
+def search_records(q, limit):
+    """Return up to ``limit`` ranked ``(title, url)`` hits per kind."""
+    results = {kind: [] for kind in SEARCH_SOURCES}
+    match = fts_match(q)
+    if not match:
+        return results
+    rows = db.session.execute(
+        db.text(
+            "SELECT kind, title, model, record_id FROM ("
+            " SELECT kind, title, model, record_id, row_number() OVER"
+            " (PARTITION BY kind ORDER BY bm25(search_index, 10.0, 1.0)) AS pos"
+            " FROM search_index WHERE search_index MATCH :match"
+            ") WHERE pos <= :limit ORDER BY kind, pos"
+        ),
+        {"match": match, "limit": limit},
+    )
+    for kind, title, model, record_id in rows:
+        results[kind].append((title, record_url(model, record_id)))
+    return results
+
+
+# --- Kanban boards --------------------------------------------------------
+# board -> (model, status attribute, amount attribute or None)
+KANBAN_BOARDS = {
+    "lead": (Lead, "status", None),
+    "deal": (Deal, "stage", "amount"),
+    "task": (Task, "status", None),
+}
+
+
+def kanban_columns(board, statuses, limit):
+    """Load the first ``limit`` cards of every status column in one query."""
+    model, status_attr, _ = KANBAN_BOARDS[board]
+    status = getattr(model, status_attr)
+    pos = db.func.row_number().over(partition_by=status, order_by=model.id)
+    ranked = db.select(model, pos.label("pos")).where(status.in_(statuses)).subquery()
+    card = db.aliased(model, ranked)
+    stmt = db.select(card).where(ranked.c.pos <= limit).order_by(ranked.c.pos)
+    if model in CONVERTED_AMOUNTS:
+        stmt = stmt.options(with_converted(model, card))
+    rows = db.session.execute(stmt).scalars()
+    columns = {s: [] for s in statuses}
+    for r in rows:
+        columns[getattr(r, status_attr)].append(r)
+    return columns
+
+
+def kanban_summary(board, statuses):
+    """Return ``{status: (count, total)}`` for a board from one aggregate query."""
+    model, status_attr, amount_attr = KANBAN_BOARDS[board]
+    status = getattr(model, status_attr)
+    total = (
+        db.func.coalesce(db.func.sum(converted_column(model)), 0)
+        if amount_attr
+        else db.literal(0)
+    )
+    rows = db.session.execute(
+        db.select(status, db.func.count(model.id), total)
+        .where(status.in_(statuses))
+        .group_by(status)
+    )
+    summary = {s: (0, 0) for s in statuses}
+    summary.update({s: (count, total) for s, count, total in rows})
+    return summary
+
+
+def render_kanban(board, title):
+    model, _, amount_attr = KANBAN_BOARDS[board]
+    unchanged = not_modified(model.__tablename__, "status_option", "exchange_rate")
+    if unchanged:
+        return unchanged
+    statuses = [s.value for s in status_options(board)]
+    limit = app.config["KANBAN_COLUMN_SIZE"]
+    columns = kanban_columns(board, statuses, limit)
+    summary = kanban_summary(board, statuses)
+    cursors = {
+        s: cards[-1].id if summary[s][0] > len(cards) else None
+        for s, cards in columns.items()
+    }
+    return render_template(
+        "kanban.html",
+        columns=columns,
+        counts={s: count for s, (count, _) in summary.items()},
+        totals={s: total for s, (_, total) in summary.items()} if amount_attr else None,
+        cursors=cursors,
+        title=title,
+        model=board,
+    )
+
+
+def apply_status_moves(moves):
+    """Move kanban cards given as ``{"model", "id", "status"}`` dicts.
+
+    Every move is checked against the board's configured statuses before
+    anything is written; then each board gets a single UPDATE that sets
+    every moved record's status through a CASE on its id. Returns the number
+    of moves applied, or raises ValueError naming the first invalid move.
+    The caller commits.
+    """
+    targets = {}  # board -> {record id: status}; a later move of a card wins
+    allowed = {}  # board -> configured statuses
+    for n, move in enumerate(moves):
+        board = move.get("model") if isinstance(move, dict) else None
+        if board not in KANBAN_BOARDS:
+            raise ValueError(f"move {n}: unknown model")
+        try:
+            record_id = int(move.get("id"))
+        except (TypeError, ValueError):
+            raise ValueError(f"move {n}: invalid id") from None
+        if board not in allowed:
+            allowed[board] = {s.value for s in status_options(board)}
+        if move.get("status") not in allowed[board]:
+            raise ValueError(f"move {n}: unknown status")
+        targets.setdefault(board, {})[record_id] = move["status"]
+    for board, statuses in targets.items():
+        model, status_attr, _ = KANBAN_BOARDS[board]
+        db.session.execute(
+            db.update(model)
+            .where(model.id.in_(statuses))
+            .values({status_attr: db.case(statuses, value=model.id)})
+            .execution_options(synchronize_session=False)
+        )
+        # Bulk UPDATEs skip the flush hooks, so record the write by hand.
+        record_table_writes(db.session, [model.__tablename__])
+    if targets:
+        queue_event(
+            db.session,
+            "status",
+            [
+                {"model": board, "id": record_id, "status": status}
+                for board, statuses in targets.items()
+                for record_id, status in statuses.items()
+            ],
+        )
+    return sum(len(statuses) for statuses in targets.values())
+
+
+# --- Notification counters ------------------------------------------------
+def bump_unread_notifications(user_ids, delta):
+    if user_ids:
+        db.session.execute(
+            db.update(User)
+            .where(User.id.in_(user_ids))
+            .values(unread_notifications=User.unread_notifications + delta)
+            .execution_options(synchronize_session=False)
+        )
+        forget_identities_on_commit(db.session, user_ids)
+
+
+def reconcile_notification_counts():
+    """Recompute every user's unread counter from the notification table."""
+    unread = (
+        db.select(db.func.count(Notification.id))
+        .where(Notification.user_id == User.id, Notification.is_read == db.false())
+        .scalar_subquery()
+    )
+    result = db.session.execute(
+        db.update(User)
+        .where(User.unread_notifications.is_distinct_from(unread))
+        .values(unread_notifications=unread)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+@app.cli.command("reconcile-notifications")
+def reconcile_notifications_command():
+    """Correct drift in the per-user unread notification counters."""
+    click.echo(f"Corrected {reconcile_notification_counts()} user(s).")
+
+
+# --- Quote totals ---------------------------------------------------------
+# Quote.total is derived from the quote's line items. Every flush that adds,
+# edits or deletes line items first moves the affected totals by the change
+# in quantity * price, so reads never have to sum the line items.
+def _line_amount(quantity, price):
+    try:
+        return float(quantity or 0) * float(price or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _committed(item, attr):
+    """Return the value ``attr`` had before the changes being flushed."""
+    history = db.inspect(item).attrs[attr].history
+    if history.deleted:
+        return history.deleted[0]
+    if history.added:
+        return None
+    return getattr(item, attr)
+
+
+def _line_quote(item):
+    """Return the id of the quote ``item`` is being flushed into.
+
+    Items attached through the relationship (``item.quote = q`` or
+    ``q.line_items.append(item)``) only get their quote_id during the flush,
+    so a changed relationship wins; a quote inserted by the same flush has
+    no id yet and is returned itself.
+    """
+    history = db.inspect(item).attrs.quote.history
+    if not history.has_changes():
+        return item.quote_id
+    quote = history.added[0] if history.added else None
+    if quote is None or quote.id is None:
+        return quote
+    return quote.id
+
+
+@db.event.listens_for(db.session, "before_flush")
+def adjust_quote_totals(session, flush_context, instances):
+    deltas = Counter()
+    for item in session.new:
+        if isinstance(item, QuoteLineItem) and item not in session.deleted:
+            deltas[_line_quote(item)] += _line_amount(item.quantity, item.price)
+    for item in itertools.chain(session.dirty, session.deleted):
+        if not isinstance(item, QuoteLineItem):
+            continue
+        old = _committed(item, "quote_id")
+        deltas[old] -= _line_amount(_committed(item, "quantity"), _committed(item, "price"))
+        if item not in session.deleted:
+            deltas[_line_quote(item)] += _line_amount(item.quantity, item.price)
+    changes = []
+    for target, delta in deltas.items():
+        if isinstance(target, Quote):
+            target.total = (target.total or 0) + delta
+        elif target not in (None, "") and delta:
+            changes.append({"quote": int(target), "delta": delta})
+    if changes:
+        quote = Quote.__table__
+        # Relative updates, so concurrent edits of one quote cannot lose a change.
+        session.connection().execute(
+            quote.update()
+            .where(quote.c.id == db.bindparam("quote"))
+            .values(total=db.func.coalesce(quote.c.total, 0) + db.bindparam("delta")),
+            changes,
+        )
+        record_table_writes(session, [Quote.__tablename__])
+
+
+def form_quote_id():
+    """Return the submitted ``quote_id`` as an int, None if blank; 400 otherwise."""
+    value = (request.form.get("quote_id") or "").strip()
+    if not value:
+        return None
+    if not value.isdigit():
+        abort(400, "quote_id must be a quote id")
+    return int(value)
+
+
+def recompute_quote_totals():
+    """Reset every quote total to the sum of its line items; return the count."""
+    amount = db.func.coalesce(QuoteLineItem.quantity, 0) * db.func.coalesce(
+        QuoteLineItem.price, 0
+    )
+    summed = db.func.coalesce(
+        db.select(db.func.sum(amount))
+        .where(QuoteLineItem.quote_id == Quote.id)
+        .scalar_subquery(),
+        0,
+    )
+    result = db.session.execute(
+        db.update(Quote)
+        .where(Quote.total.is_distinct_from(summed))
+        .values(total=summed)
+        .execution_options(synchronize_session=False)
+    )
+    record_table_writes(db.session, [Quote.__tablename__])
+    db.session.commit()
+    return result.rowcount
+
+
+@app.cli.command("recompute-quote-totals")
+def recompute_quote_totals_command():
+    """Recompute every quote total from its line items."""
+    click.echo(f"Corrected {recompute_quote_totals()} quote(s).")
+
+
+# --- Pricing ---------------------------------------------------------------
+# Each process keeps every price book entry and product list price in a dict,
+# so pricing a cart is one version check rather than one query per line.
+def load_price_index():
+    """Return ``({(pricebook_id, product_id): unit_price}, {product_id: price})``."""
+    # Ordered by id, so the newest of duplicate entries wins.
+    entries = {
+        (pricebook_id, product_id): unit_price
+        for pricebook_id, product_id, unit_price in db.session.execute(
+            db.select(
+                PriceBookEntry.pricebook_id,
+                PriceBookEntry.product_id,
+                PriceBookEntry.unit_price,
+            ).order_by(PriceBookEntry.id)
+        )
+    }
+    list_prices = dict(db.session.execute(db.select(Product.id, Product.price)).all())
+    return entries, list_prices
+
+
+price_index = TableSnapshot(["price_book_entry", "product"], load_price_index)
+
+
+def price_cart(pricebook_id, lines):
+    """Price ``{"product_id", "quantity", "price"?}`` dicts against a pricebook.
+
+    A line's own ``price`` wins, then the pricebook entry, then the
+    product's list price. Returns ``(priced lines, total)``, or raises
+    ValueError naming the first invalid line.
+    """
+    if len(lines) > app.config["PRICING_MAX_LINES"]:
+        raise ValueError(f"at most {app.config['PRICING_MAX_LINES']} lines")
+    try:
+        pricebook_id = None if pricebook_id in (None, "") else int(pricebook_id)
+    except (TypeError, ValueError):
+        raise ValueError("invalid pricebook_id") from None
+    entries, list_prices = price_index.get()
+    priced, total = [], 0.0
+    for n, line in enumerate(lines):
+        if not isinstance(line, dict):
+            raise ValueError(f"line {n}: not an object")
+        try:
+            product_id = int(line.get("product_id"))
+            quantity = line.get("quantity", 1)
+            if isinstance(quantity, float) and not quantity.is_integer():
+                raise ValueError
+            quantity = int(quantity)
+            price = line.get("price")
+            price = None if price in (None, "") else float(price)
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError(f"line {n}: invalid product_id, quantity or price") from None
+        if quantity < 1:
+            raise ValueError(f"line {n}: quantity must be at least 1")
+        if price is not None and not math.isfinite(price):
+            raise ValueError(f"line {n}: price must be a finite number")
+        if product_id not in list_prices:
+            raise ValueError(f"line {n}: unknown product")
+        if price is not None:
+            source = "line"
+        elif (pricebook_id, product_id) in entries:
+            price, source = entries[pricebook_id, product_id], "pricebook"
+        else:
+            price, source = list_prices[product_id], "product"
+        amount = _line_amount(quantity, price)
+        total += amount
+        priced.append(
+            {
+                "product_id": product_id,
+                "quantity": quantity,
+                "unit_price": price,
+                "amount": amount,
+                "source": source,
+            }
+        )
+    return priced, total
+
+
+# --- Currency conversion --------------------------------------------------
+# Amounts are stored in BASE_CURRENCY and shown in the viewer's currency. The
+# rate table is held in memory; lists and aggregates convert inside their SQL
+# through a CASE over the effective dates, single values convert in Python.
+# model -> (amount attribute, date attribute picking the rate, or None for today)
+CONVERTED_AMOUNTS = {
+    Deal: ("amount", "close_date"),
+    Quote: ("total", None),
+}
+
+
+def load_exchange_rates():
+    """Return ``{currency: [(ISO effective date, rate), ...]}``, oldest first."""
+    rates = {}
+    for currency, rate, effective in db.session.execute(
+        db.select(ExchangeRate.currency, ExchangeRate.rate, ExchangeRate.effective_date)
+        .order_by(ExchangeRate.currency, ExchangeRate.effective_date)
+    ):
+        rates.setdefault(currency, []).append((effective.isoformat(), rate))
+    return rates
+
+
+exchange_rates = TableSnapshot(["exchange_rate"], load_exchange_rates)
+
+
+def viewer_rates():
+    """Return ``(currency, rates)`` for the viewer, once per request.
+
+    Viewers whose currency has no rates, and code running outside a
+    request, get BASE_CURRENCY and no rates.
+    """
+    if not has_request_context():
+        return app.config["BASE_CURRENCY"], None
+    if "viewer_rates" not in g:
+        currency = current_user.currency if current_user.is_authenticated else None
+        rates = None
+        if currency and currency != app.config["BASE_CURRENCY"]:
+            rates = exchange_rates.get().get(currency)
+        g.viewer_rates = (currency, rates) if rates else (app.config["BASE_CURRENCY"], None)
+    return g.viewer_rates
+
+
+def display_currency():
+    return viewer_rates()[0]
+
+
+def _rate_entry(rates, on):
+    """Return the ``(effective date, rate)`` in effect on ISO date ``on``.
+
+    Dates before the first rate use the oldest one.
+    """
+    i = bisect.bisect_right(rates, (on, float("inf")))
+    return rates[max(i - 1, 0)]
+
+
+def _rate_on(rates, on):
+    return _rate_entry(rates, on)[1]
+
+
+def current_rate_date():
+    """Effective date of the viewer's rate for today, or None if unconverted.
+
+    Undated amounts use this rate, so it belongs in ETags: a rate recorded
+    for a future date takes over without the exchange_rate table changing.
+    """
+    rates = viewer_rates()[1]
+    if not rates:
+        return None
+    return _rate_entry(rates, date.today().isoformat())[0]
+
+
+def convert_amount(amount, on=None):
+    """Convert one BASE_CURRENCY ``amount`` with the rate in effect ``on``."""
+    rates = viewer_rates()[1]
+    if amount in (None, "") or not rates:
+        return amount
+    return float(amount) * _rate_on(rates, on or date.today().isoformat())
+
+
+def converted(amount, on=None):
+    """SQL expression for ``amount`` in the viewer's currency.
+
+    ``on`` is the ISO date column whose rate applies; rows without a date,
+    and every row when ``on`` is None, use today's rate.
+    """
+    rates = viewer_rates()[1]
+    if not rates:
+        return amount
+    today = _rate_on(rates, date.today().isoformat())
+    if on is None:
+        return amount * today
+    rate = db.case(
+        (db.or_(on.is_(None), on == ""), today),
+        *[(on >= effective, r) for effective, r in reversed(rates[1:])],
+        else_=rates[0][1],
+    )
+    return amount * rate
+
+
+def converted_column(model, entity=None):
+    """``model``'s amount in the viewer's currency, for ``entity`` or an alias of it."""
+    entity = entity if entity is not None else model
+    amount, on = CONVERTED_AMOUNTS[model]
+    return converted(getattr(entity, amount), getattr(entity, on) if on else None)
+
+
+def with_converted(model, entity=None):
+    """Loader option that fills ``converted`` on every row of the result."""
+    entity = entity if entity is not None else model
+    return db.with_expression(entity.converted, converted_column(model, entity))
+
+
+@app.template_global()
+def money(amount, on=None, convert=True):
+    """Format a BASE_CURRENCY amount, or an already converted one, for the viewer."""
+    if amount in (None, ""):
+        return ""
+    if convert:
+        amount = convert_amount(amount, on)
+    return f"{float(amount):,.2f} {display_currency()}"
+
+
+@app.cli.command("set-exchange-rate")
+@click.argument("currency")
+@click.argument("rate", type=float)
+@click.option("--date", "effective", default=None, help="Effective date (YYYY-MM-DD), default today.")
+def set_exchange_rate_command(currency, rate, effective):
+    """Record how many CURRENCY one BASE_CURRENCY buys from a date on."""
+    effective = date.fromisoformat(effective) if effective else date.today()
+    currency = currency.upper()
+    row = ExchangeRate.query.filter_by(currency=currency, effective_date=effective).first()
+    if row:
+        row.rate = rate
+    else:
+        db.session.add(ExchangeRate(currency=currency, rate=rate, effective_date=effective))
+    db.session.commit()
+    click.echo(f"1 {app.config['BASE_CURRENCY']} = {rate} {currency} from {effective}.")
+
+
+# --- Mention notifications ------------------------------------------------
+MENTION_RE = re.compile(r"@(\w+)")
+
+
+def fan_out_mentions(messages):
+    """Notify the users mentioned in ``messages``.
+
+    Usernames are resolved with one ``IN`` query and the notifications are
+    inserted in one statement, however many users a message mentions.
+    """
+    mentions = {m.id: set(MENTION_RE.findall(m.content or "")) for m in messages}
+    usernames = set().union(*mentions.values())
+    if not usernames:
+        return 0
+    user_ids = dict(
+        db.session.execute(
+            db.select(User.username, User.id).where(User.username.in_(usernames))
+        ).all()
+    )
+    rows = [
+        {
+            "user_id": user_ids[name],
+            "message_id": m.id,
+            "model": m.model,
+            "record_id": m.record_id,
+        }
+        for m in messages
+        for name in sorted(mentions[m.id])
+        if name in user_ids
+    ]
+    if rows:
+        db.session.execute(db.insert(Notification), rows)
+        record_table_writes(db.session, [Notification.__tablename__])
+        per_user = Counter(row["user_id"] for row in rows)
+        for delta in set(per_user.values()):
+            bump_unread_notifications(
+                [user_id for user_id, n in per_user.items() if n == delta], delta
+            )
+        for user_id, n in per_user.items():
+            queue_event(db.session, "notification", {"delta": n}, user_id=user_id)
+    return len(rows)
+
+
+def deliver_pending_notifications(batch_size=100):
+    """Fan out queued messages; safe to run from several workers at once.
+
+    Each batch is claimed by flipping ``notified`` in a conditional UPDATE, so
+    a message is only delivered by the worker whose UPDATE matched it, in the
+    same transaction as its notifications.
+    """
+    delivered = 0
+    while True:
+        ids = db.session.scalars(
+            db.select(Message.id)
+            .where(Message.notified == db.false())
+            .order_by(Message.id)
+            .limit(batch_size)
+        ).all()
+        if not ids:
+            return delivered
+        claimed = db.session.scalars(
+            db.update(Message)
+            .where(Message.id.in_(ids), Message.notified == db.false())
+            .values(notified=True)
+            .returning(Message.id)
+            .execution_options(synchronize_session=False)
+        ).all()
+        if claimed:
+            delivered += fan_out_mentions(
+                Message.query.filter(Message.id.in_(claimed)).all()
+            )
+        db.session.commit()
+
+
+@app.cli.command("deliver-notifications")
+def deliver_notifications_command():
+    """Deliver queued mention notifications now."""
+    click.echo(f"Delivered {deliver_pending_notifications()} notification(s).")
+
+
+# --- Schema migrations ----------------------------------------------------
+# Steps run in order against databases older than their version. Each step
+# must also be a no-op on a database freshly created by ``db.create_all()``.
+schema_version = db.Table(
+    "schema_version", db.metadata, db.Column("version", db.Integer, nullable=False)
+)
+
+
+def _add_missing_columns(model, names):
+    """Add the model columns ``names`` that the database table lacks.
+
+    The DDL is compiled from the model's column definitions for the current
+    dialect, so table quoting and types work on SQLite and PostgreSQL.
+    """
+    table = model.__table__
+    existing = {c["name"] for c in db.inspect(db.engine).get_columns(table.name)}
+    missing = [name for name in names if name not in existing]
+    dialect = db.engine.dialect
+    ddl = dialect.ddl_compiler(dialect, None)
+    for name in missing:
+        db.session.execute(
+            db.text(
+                f"ALTER TABLE {ddl.preparer.format_table(table)}"
+                f" ADD COLUMN {ddl.get_column_specification(table.c[name])}"
+            )
+        )
+    return missing
+
+
+def migrate_user_preferences():
+    _add_missing_columns(User, ["language", "timezone", "country", "currency"])
+
+
+def migrate_unread_notifications():
+    if _add_missing_columns(User, ["unread_notifications"]):
+        reconcile_notification_counts()
+
+
+def migrate_message_outbox():
+    _add_missing_columns(Message, ["notified"])
+
+
+def migrate_job_heartbeat():
+    _add_missing_columns(Job, ["heartbeat_at"])
+
+
+def migrate_message_thread_index():
+    db.session.execute(db.text("DROP INDEX IF EXISTS ix_message_record"))
+    migrate_indexes()
+
+
+def migrate_name_keys():
+    for table in ("account", "deal", "product", "pricebook"):
+        db.session.execute(db.text(f"DROP INDEX IF EXISTS ix_{table}_name_lower"))
+    for model in (Account, Deal, Product, Pricebook):
+        if _add_missing_columns(model, ["name_key"]):
+            rows = db.session.execute(db.select(model.id, model.name)).all()
+            if rows:
+                db.session.execute(
+                    db.update(model.__table__)
+                    .where(model.id == db.bindparam("row_id"))
+                    .values(name_key=db.bindparam("key")),
+                    [{"row_id": id_, "key": fold_name(name)} for id_, name in rows],
+                )
+    migrate_indexes()
+
+
+def migrate_indexes():
+    """Create the model indexes the database lacks.
+
+    Indexes on columns a later step adds are skipped; that step is followed
+    by another ``migrate_indexes``. IF NOT EXISTS is used rather than
+    checkfirst because SQLite reflection skips expression indexes.
+    """
+    inspector = db.inspect(db.session.connection())
+    for table in db.metadata.sorted_tables:
+        present = {c["name"] for c in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            if {c.name for c in index.columns} <= present:
+                db.session.execute(db.schema.CreateIndex(index, if_not_exists=True))
+
+
+MIGRATIONS = [
+    (1, migrate_user_preferences),
+    (2, migrate_unread_notifications),
+    (3, migrate_indexes),
+    (4, migrate_indexes),
+    (5, migrate_message_outbox),
+    (6, migrate_indexes),
+    (7, migrate_job_heartbeat),
+    (8, migrate_message_thread_index),
+    (9, migrate_name_keys),
+]
+
+
+def upgrade_schema():
+    current = db.session.scalar(db.select(db.func.max(schema_version.c.version))) or 0
+    for version, step in MIGRATIONS:
+        if version > current:
+            step()
+            db.session.execute(schema_version.insert().values(version=version))
+            db.session.commit()
+
+
+@app.cli.command("upgrade-db")
+def upgrade_db_command():
+    """Apply pending schema migrations."""
+    upgrade_schema()
+    click.echo(f"Database at schema version {MIGRATIONS[-1][0]}.")
+
+
+# --- Record detail pages ---------------------------------------------------
+def load_activity(kind, record_id):
+    """Return a record's tasks, one page of its messages and the older cursor.
+
+    Message authors are loaded with the messages, so a detail page runs the
+    same number of queries however long its thread is.
+    """
+    tasks = Task.query.filter_by(model=kind, record_id=record_id).all()
+    size = app.config["MESSAGE_PAGE_SIZE"]
+    query = Message.query.options(db.joinedload(Message.user)).filter_by(
+        model=kind, record_id=record_id
+    )
+    before = request.args.get("messages_before", type=int)
+    if before is not None:
+        query = query.filter(Message.id < before)
+    messages = query.order_by(Message.id.desc()).limit(size + 1).all()
+    older = messages[size - 1].id if len(messages) > size else None
+    return tasks, messages[:size], older
+
+
+def render_detail(model, kind, record_id, template, name, title):
+    unchanged = not_modified(
+        *record_tables(model), "task", "message", "user", "exchange_rate"
+    )
+    if unchanged:
+        return unchanged
+    record = view_query(model).get_or_404(record_id)
+    tasks, messages, older = load_activity(kind, record_id)
+    return render_template(
+        template,
+        tasks=tasks,
+        messages=messages,
+        messages_older=older,
+        model=kind,
+        record_id=record_id,
+        title=title,
+        **{name: record},
+    )
+
+
+# --- List queries and export ----------------------------------------------
+# kind -> (model, column searched by ``q``). Kinds without a search column
+# treat ``q`` as a record id.
+LIST_SOURCES = {
+    "leads": (Lead, "name"),
+    "accounts": (Account, "name"),
+    "contacts": (Contact, "name"),
+    "deals": (Deal, "name"),
+    "products": (Product, "name"),
+    "pricebooks": (Pricebook, "name"),
+    "pricebook_entries": (PriceBookEntry, None),
+    "quotes": (Quote, None),
+    "quote_line_items": (QuoteLineItem, None),
+    "tasks": (Task, "description"),
+}
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+def list_query(kind, q):
+    """Return the query behind the ``kind`` list view filtered by ``q``."""
+    model, column = LIST_SOURCES[kind]
+    query = view_query(model)
+    if not q:
+        return query
+    if column:
+        return search_filter(query, model, getattr(model, column), q)
+    try:
+        return query.filter(model.id == int(q))
+    except ValueError:
+        return query.filter(model.id == -1)
+
+
+def export_rows(kind, q, fmt):
+    """Yield ``kind`` rows matching ``q`` as CSV or NDJSON text chunks.
+
+    Rows are read through a streaming cursor in ``EXPORT_CHUNK_SIZE``
+    batches, so memory use does not depend on the table size.
+    """
+    model = LIST_SOURCES[kind][0]
+    columns = [c.key for c in model.__table__.columns]
+    chunk_size = app.config["EXPORT_CHUNK_SIZE"]
+    rows = (
+        list_query(kind, q)
+        .with_entities(*model.__table__.columns)
+        .order_by(model.id)
+        .yield_per(chunk_size)
+    )
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if fmt == "csv":
+        writer.writerow(columns)
+    for n, row in enumerate(rows, 1):
+        if fmt == "csv":
+            writer.writerow(row)
+        else:
+            buf.write(json.dumps(dict(zip(columns, row)), default=str) + "\n")
+        if n % chunk_size == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+@app.route("/export/<kind>")
+def export_records(kind):
+    fmt = request.args.get("format", "csv")
+    if kind not in LIST_SOURCES or fmt not in EXPORT_FORMATS:
+        return {"error": "export"}, 404
+    q = request.args.get("q", "")
+    return Response(
+        stream_with_context(export_rows(kind, q, fmt)),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename={kind}.{fmt}"},
+    )
+
+
+# --- Bulk import -----------------------------------------------------------
+# kind -> (model, importable fields); every kind requires a name.
+IMPORT_SOURCES = {
+    "leads": (Lead, ("name", "email", "phone", "company", "notes", "status")),
+    "accounts": (Account, ("name", "industry", "email", "phone", "address", "notes")),
+    "contacts": (Contact, ("name", "email", "phone", "title", "account_id")),
+}
+IMPORT_FORMATS = ("csv", "jsonl")
+
+
+def import_format(filename):
+    return "jsonl" if filename.lower().endswith((".jsonl", ".ndjson")) else "csv"
+
+
+def iter_import_rows(stream, fmt):
+    """Yield ``(row number, record or None, error or None)`` from a text stream."""
+    if fmt == "csv":
+        for row, record in enumerate(csv.DictReader(stream), 1):
+            yield row, record, None
+        return
+    for row, line in enumerate(stream, 1):
+        if not line.strip():
+            yield row, None, "empty line"
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as exc:
+            yield row, None, f"invalid JSON: {exc}"
+            continue
+        if isinstance(record, dict):
+            yield row, record, None
+        else:
+            yield row, None, "expected a JSON object"
+
+
+def validate_import_row(kind, record):
+    """Return ``(values, error)`` for one raw import record."""
+    model, fields = IMPORT_SOURCES[kind]
+    values = {}
+    for field in fields:
+        value = record.get(field)
+        value = str(value).strip() if value is not None else ""
+        length = getattr(model.__table__.c[field].type, "length", None)
+        if length and len(value) > length:
+            return None, f"{field} is longer than {length} characters"
+        values[field] = value or None
+    if not values["name"]:
+        return None, "name is required"
+    if values.get("account_id"):
+        try:
+            values["account_id"] = int(values["account_id"])
+        except ValueError:
+            return None, "account_id must be an integer"
+    return values, None
+
+
+def _flush_import_batch(run, rows, errors, batch):
+    model = IMPORT_SOURCES[run.kind][0]
+    account_ids = {values.get("account_id") for _, values in batch} - {None}
+    if account_ids:
+        known = set(
+            db.session.scalars(db.select(Account.id).where(Account.id.in_(account_ids)))
+        )
+        missing = account_ids - known
+        errors.extend(
+            (row, f"account {values['account_id']} does not exist")
+            for row, values in batch
+            if values.get("account_id") in missing
+        )
+        batch = [(row, v) for row, v in batch if v.get("account_id") not in missing]
+    if batch:
+        ids = db.session.scalars(
+            db.insert(model).returning(model.id), [values for _, values in batch]
+        ).all()
+        if app.config["SEARCH_FTS"]:
+            index_search_rows(run.kind, model.id.in_(ids))
+    if errors:
+        db.session.execute(
+            db.insert(ImportRowError),
+            [{"run_id": run.id, "row": row, "message": msg[:255]} for row, msg in errors],
+        )
+    if batch:
+        record_table_writes(db.session, [model.__tablename__])
+    run.rows_done = rows
+    run.inserted += len(batch)
+    run.failed += len(errors)
+    run.updated_at = datetime.utcnow()
+    job_heartbeat()
+    db.session.commit()
+
+
+def run_import(run, stream, batch_size=None, progress=None):
+    """Stream ``stream`` into ``run.kind`` in committed batches.
+
+    Rows up to ``run.rows_done`` are skipped, so an interrupted run resumes
+    by calling this again with the same file. ``progress`` is called with
+    the run after every committed batch.
+    """
+    batch_size = batch_size or app.config["IMPORT_BATCH_SIZE"]
+    run.status = "running"
+    db.session.commit()
+    rows, batch, errors = run.rows_done, [], []
+    for row, record, error in iter_import_rows(stream, run.format):
+        if row <= run.rows_done:
+            continue
+        rows = row
+        if error is None:
+            values, error = validate_import_row(run.kind, record)
+        if error is None:
+            batch.append((row, values))
+        else:
+            errors.append((row, error))
+        if len(batch) + len(errors) >= batch_size:
+            _flush_import_batch(run, rows, errors, batch)
+            batch, errors = [], []
+            if progress:
+                progress(run)
+    _flush_import_batch(run, rows, errors, batch)
+    run.status = "finished"
+    db.session.commit()
+    if progress:
+        progress(run)
+    return run
+
+
+def import_upload_path(run):
+    """Where an import uploaded through the admin page is kept until done."""
+    return os.path.join(app.instance_path, "imports", f"{run.id}.{run.format}")
+
+
+@app.cli.command("import-records")
+@click.argument("kind", type=click.Choice(list(IMPORT_SOURCES)))
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(IMPORT_FORMATS))
+@click.option("--batch-size", type=int)
+@click.option("--resume", "resume_id", type=int, help="Continue an interrupted run.")
+def import_records_command(kind, path, fmt, batch_size, resume_id):
+    """Bulk import leads, accounts or contacts from a CSV or JSONL file."""
+    if resume_id:
+        run = db.session.get(ImportRun, resume_id)
+        if run is None or run.kind != kind:
+            raise click.ClickException(f"No {kind} import run {resume_id}.")
+    else:
+        run = ImportRun(
+            kind=kind,
+            filename=os.path.basename(path),
+            format=fmt or import_format(path),
+            rows_done=0,
+            inserted=0,
+            failed=0,
+        )
+        db.session.add(run)
+        db.session.commit()
+
+    def report(run):
+        click.echo(
+            f"run {run.id}: {run.rows_done} rows read, {run.inserted} inserted,"
+            f" {run.failed} failed"
+        )
+
+    with open(path, encoding="utf-8-sig", newline="") as stream:
+        run_import(run, stream, batch_size, report)
+
+
+# --- Dashboard -------------------------------------------------------------
+DASHBOARD_COUNTS = {
+    "leads": Lead,
+    "accounts": Account,
+    "contacts": Contact,
+    "deals": Deal,
+    "products": Product,
+    "pricebooks": Pricebook,
+    "quotes": Quote,
+}
+
+
+def dashboard_counts():
+    """Return the dashboard record counts, computed in a single statement."""
+
+    def compute():
+        row = db.session.execute(
+            db.select(
+                *[
+                    db.select(db.func.count()).select_from(model).scalar_subquery().label(key)
+                    for key, model in DASHBOARD_COUNTS.items()
+                ]
+            )
+        ).one()
+        return row._asdict()
+
+    return cache.cached(
+        "dashboard_counts",
+        compute,
+        tags=[model.__table__.name for model in DASHBOARD_COUNTS.values()],
+        ttl=app.config["DASHBOARD_CACHE_TTL"],
+    )
+
+
+def record_url(model, record_id):
+    mapping = {
+        "leads": ("show_lead", "lead_id"),
+        "accounts": ("show_account", "account_id"),
+        "contacts": ("show_contact", "contact_id"),
+        "deals": ("show_deal", "deal_id"),
+        "products": ("show_product", "product_id"),
+        "pricebooks": ("show_pricebook", "pricebook_id"),
+        "pricebook_entries": ("show_pricebook_entry", "entry_id"),
+        "quotes": ("show_quote", "quote_id"),
+        "quote_line_items": ("show_quote_line_item", "item_id"),
+    }
+    view, param = mapping.get(model, (None, None))
+    if view:
+        return url_for(view, **{param: record_id})
+    return url_for("dashboard")
+
+
+# --- SQLite tuning ---------------------------------------------------------
+def apply_sqlite_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+@db.event.listens_for(db.Engine, "connect")
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        apply_sqlite_pragmas(dbapi_connection, app.config["SQLITE_PRAGMAS"])
+
+
+def sqlite_maintenance(checkpoint="PASSIVE"):
+    """Checkpoint the WAL into the database file and refresh planner stats."""
+    with db.engine.connect() as conn:
+        conn.exec_driver_sql(f"PRAGMA wal_checkpoint({checkpoint})")
+        conn.exec_driver_sql("PRAGMA optimize")
+
+
+next_sqlite_maintenance = time.monotonic() + app.config["SQLITE_MAINTENANCE_INTERVAL"]
+
+
+@app.after_request
+def schedule_sqlite_maintenance(response):
+    global next_sqlite_maintenance
+    interval = app.config["SQLITE_MAINTENANCE_INTERVAL"]
+    now = time.monotonic()
+    if interval and now >= next_sqlite_maintenance and db.engine.dialect.name == "sqlite":
+        next_sqlite_maintenance = now + interval
+
+        def run():
+            with app.app_context():
+                sqlite_maintenance()
+
+        response.call_on_close(run)
+    return response
+
+
+@app.cli.command("sqlite-maintenance")
+def sqlite_maintenance_command():
+    """Truncate the SQLite WAL and run PRAGMA optimize."""
+    sqlite_maintenance("TRUNCATE")
+    click.echo("SQLite maintenance done.")
+
+
+# --- Background jobs -------------------------------------------------------
+# Slow work is queued in the job table and run by a pool of worker threads,
+# started in each web process (CRM_JOB_RUNNER=thread) or by separate
+# ``flask run-jobs`` processes (CRM_JOB_RUNNER=worker). Jobs are claimed with
+# a conditional UPDATE, so any number of workers can share one queue.
+JOB_HANDLERS = {}
+# Jobs an admin can queue from the jobs page.
+MAINTENANCE_JOBS = (
+    "rebuild_search_index",
+    "reconcile_notifications",
+    "sqlite_maintenance",
+    "prune_jobs",
+)
+
+
+def job_handler(kind):
+    def register(func):
+        JOB_HANDLERS[kind] = func
+        return func
+
+    return register
+
+
+def enqueue_job(kind, delay=0, **payload):
+    """Queue ``kind`` in the current transaction; it runs once committed."""
+    job = Job(
+        kind=kind,
+        payload=json.dumps(payload),
+        max_attempts=app.config["JOB_MAX_ATTEMPTS"],
+        run_at=datetime.utcnow() + timedelta(seconds=delay),
+    )
+    db.session.add(job)
+    db.session.info["jobs_enqueued"] = True
+    return job
+
+
+@db.event.listens_for(db.session, "after_commit")
+def wake_job_workers(session):
+    if session.info.pop("jobs_enqueued", False):
+        job_pool.wake()
+
+
+class JobLeaseLost(RuntimeError):
+    """The running job was requeued and claimed again by another worker."""
+
+
+def job_heartbeat():
+    """Renew the lease of the job this worker is running, if any.
+
+    Runs in the caller's transaction, so the lease moves only when the
+    progress it vouches for is committed. Raises JobLeaseLost if the job
+    was requeued meanwhile, rolling back work another worker now owns.
+    """
+    lease = g.get("job_lease")
+    if lease is None:
+        return
+    job_id, attempts = lease
+    renewed = db.session.execute(
+        db.update(Job)
+        .where(Job.id == job_id, Job.status == "running", Job.attempts == attempts)
+        .values(heartbeat_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not renewed:
+        raise JobLeaseLost(f"job {job_id} was requeued while running")
+
+
+def requeue_stale_jobs():
+    """Requeue running jobs whose worker died without finishing them."""
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config["JOB_STALE_AFTER"])
+    db.session.execute(
+        db.update(Job)
+        .where(
+            Job.status == "running",
+            db.func.coalesce(Job.heartbeat_at, Job.started_at) < cutoff,
+        )
+        .values(status="queued", run_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+def claim_job():
+    """Mark the next due job as running and return it, or None."""
+    while True:
+        now = datetime.utcnow()
+        job_id = db.session.scalar(
+            db.select(Job.id)
+            .where(Job.status == "queued", Job.run_at <= now)
+            .order_by(Job.run_at, Job.id)
+            .limit(1)
+        )
+        if job_id is None:
+            return None
+        claimed = db.session.scalar(
+            db.update(Job)
+            .where(Job.id == job_id, Job.status == "queued")
+            .values(
+                status="running", started_at=now, heartbeat_at=now, attempts=Job.attempts + 1
+            )
+            .returning(Job.id)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        if claimed is not None:
+            return db.session.get(Job, claimed)
+
+
+def run_next_job():
+    """Run one due job; return False when the queue has nothing due."""
+    job = claim_job()
+    if job is None:
+        return False
+    job_id, kind, payload = job.id, job.kind, json.loads(job.payload or "{}")
+    g.job_lease = (job_id, job.attempts)
+    try:
+        JOB_HANDLERS[kind](**payload)
+        job_heartbeat()
+    except JobLeaseLost:
+        # The job belongs to the worker that claimed it again; leave it be.
+        db.session.rollback()
+        app.logger.warning("Job %s (%s) lost its lease; abandoned", job_id, kind)
+        return True
+    except Exception:
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        if (job.status, job.attempts) != ("running", g.job_lease[1]):
+            app.logger.exception("Job %s (%s) failed after losing its lease", job_id, kind)
+            return True
+        job.error = traceback.format_exc()[-4000:]
+        if job.attempts < job.max_attempts:
+            # Exponential backoff: the retry delay doubles after every attempt.
+            delay = app.config["JOB_RETRY_DELAY"] * 2 ** (job.attempts - 1)
+            job.status = "queued"
+            job.run_at = datetime.utcnow() + timedelta(seconds=delay)
+        else:
+            job.status = "failed"
+            job.finished_at = datetime.utcnow()
+        app.logger.exception("Job %s (%s) failed", job_id, kind)
+    else:
+        job = db.session.get(Job, job_id)
+        job.status = "done"
+        job.error = None
+        job.finished_at = datetime.utcnow()
+    finally:
+        g.pop("job_lease", None)
+    db.session.commit()
+    return True
+
+
+class JobPool:
+    """Worker threads that run queued jobs.
+
+    Committing a transaction that queued a job wakes them; they also poll,
+    which picks up retries and jobs queued by other processes.
+    """
+
+    def __init__(self):
+        self.wakeup = threading.Event()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self, workers):
+        with self.lock:
+            while len(self.threads) < workers:
+                thread = threading.Thread(
+                    target=self.run, name=f"job-worker-{len(self.threads)}", daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+
+    def wake(self):
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            with app.app_context():
+                try:
+                    requeue_stale_jobs()
+                    while run_next_job():
+                        pass
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception("Job worker error")
+            self.wakeup.wait(app.config["JOB_POLL_INTERVAL"])
+            self.wakeup.clear()
+
+
+job_pool = JobPool()
+
+
+@app.before_request
+def start_job_pool():
+    if app.config["JOB_RUNNER"] == "thread" and not job_pool.threads:
+        job_pool.start(app.config["JOB_WORKERS"])
+
+
+def job_summary():
+    """Return queue depth per status, latency percentiles and recent jobs."""
+    depth = dict(
+        db.session.execute(db.select(Job.status, db.func.count()).group_by(Job.status)).all()
+    )
+    finished = (
+        Job.query.filter(Job.status == "done")
+        .order_by(Job.finished_at.desc())
+        .limit(200)
+        .all()
+    )
+    latency = {}
+    if finished:
+        waits = sorted((j.started_at - j.run_at).total_seconds() for j in finished)
+        runs = sorted((j.finished_at - j.started_at).total_seconds() for j in finished)
+        latency = {
+            "jobs": len(finished),
+            "wait_p50": _percentile(waits, 0.5),
+            "wait_p95": _percentile(waits, 0.95),
+            "run_p50": _percentile(runs, 0.5),
+            "run_p95": _percentile(runs, 0.95),
+        }
+    oldest = db.session.scalar(
+        db.select(db.func.min(Job.run_at)).where(
+            Job.status == "queued", Job.run_at <= datetime.utcnow()
+        )
+    )
+    recent = Job.query.order_by(Job.id.desc()).limit(50).all()
+    return depth, latency, oldest, recent
+
+
+@job_handler("deliver_notifications")
+def deliver_notifications_job():
+    deliver_pending_notifications()
 
 
-class QuoteLineItem(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    quote_id = db.Column(db.Integer, db.ForeignKey("quote.id"))
-    product_id = db.Column(db.Integer, db.ForeignKey("product.id"))
-    quantity = db.Column(db.Integer)
-    price = db.Column(db.Float)
-    quote = db.relationship("Quote", backref=db.backref("line_items", lazy=True))
-    product = db.relationship("Product")
+@job_handler("import_records")
+def import_records_job(run_id):
+    run = db.session.get(ImportRun, run_id)
+    path = import_upload_path(run)
+    try:
+        with open(path, encoding="utf-8-sig", newline="") as stream:
+            run_import(run, stream)
+    except JobLeaseLost:
+        raise  # the run now belongs to another worker
+    except Exception:
+        # Committed batches stay; a retry or a resume continues after them.
+        db.session.rollback()
+        run.status = "interrupted"
+        db.session.commit()
+        raise
+    os.remove(path)
 
 
-class Task(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    description = db.Column(db.String(255))
-    due_date = db.Column(db.String(50))
-    status = db.Column(db.String(50))
-    model = db.Column(db.String(50))
-    record_id = db.Column(db.Integer)
+@job_handler("rebuild_search_index")
+def rebuild_search_index_job():
+    if app.config["SEARCH_FTS"]:
+        rebuild_search_index()
 
 
-class Message(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
-    model = db.Column(db.String(50))
-    record_id = db.Column(db.Integer)
-    content = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    user = db.relationship("User")
+@job_handler("reconcile_notifications")
+def reconcile_notifications_job():
+    reconcile_notification_counts()
 
 
-class Notification(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
-    message_id = db.Column(db.Integer, db.ForeignKey("message.id"))
-    model = db.Column(db.String(50))
-    record_id = db.Column(db.Integer)
-    is_read = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    user = db.relationship("User")
-    message = db.relationship("Message")
+@job_handler("sqlite_maintenance")
+def sqlite_maintenance_job():
+    if db.engine.dialect.name == "sqlite":
+        sqlite_maintenance()
 
 
-def record_url(model, record_id):
-    mapping = {
-        "leads": ("show_lead", "lead_id"),
-        "accounts": ("show_account", "account_id"),
-        "contacts": ("show_contact", "contact_id"),
-        "deals": ("show_deal", "deal_id"),
-        "products": ("show_product", "product_id"),
-        "pricebooks": ("show_pricebook", "pricebook_id"),
-        "pricebook_entries": ("show_pricebook_entry", "entry_id"),
-        "quotes": ("show_quote", "quote_id"),
-        "quote_line_items": ("show_quote_line_item", "item_id"),
-    }
-    view, param = mapping.get(model, (None, None))
-    if view:
-        return url_for(view, **{param: record_id})
-    return url_for("dashboard")
+@job_handler("prune_jobs")
+def prune_jobs_job():
+    cutoff = datetime.utcnow() - timedelta(days=app.config["JOB_RETENTION_DAYS"])
+    db.session.execute(db.delete(Job).where(Job.status == "done", Job.finished_at < cutoff))
+    db.session.commit()
+
+
+@app.cli.command("run-jobs")
+@click.option("--workers", type=int, help="Worker threads (default CRM_JOB_WORKERS).")
+@click.option("--once", is_flag=True, help="Run the jobs that are due, then exit.")
+def run_jobs_command(workers, once):
+    """Run queued background jobs."""
+    if once:
+        requeue_stale_jobs()
+        count = 0
+        while run_next_job():
+            count += 1
+        click.echo(f"Ran {count} job(s).")
+        return
+    job_pool.start(workers or app.config["JOB_WORKERS"])
+    click.echo(f"Running jobs with {len(job_pool.threads)} worker(s); Ctrl+C to stop.")
+    for thread in job_pool.threads:
+        thread.join()
+
+
+# --- Keyset pagination ----------------------------------------------------
+KeysetPage = namedtuple("KeysetPage", "items next_cursor prev_cursor")
+
+
+def keyset_paginate(query, column):
+    """Return one page of ``query`` ordered by the unique ``column``.
+
+    Pages are addressed by the ``after``/``before`` cursor values in the
+    request args instead of an offset, so every page costs one index range
+    scan regardless of how deep it is.
+    """
+    size = request.args.get("per_page", app.config["PAGE_SIZE"], type=int)
+    size = max(1, min(size, app.config["MAX_PAGE_SIZE"]))
+    after = request.args.get("after", type=int)
+    before = request.args.get("before", type=int)
+    key = column.key
+    if before is not None:
+        rows = query.filter(column < before).order_by(column.desc()).limit(size + 1).all()
+        has_more = len(rows) > size
+        rows = rows[:size][::-1]
+        prev_cursor = getattr(rows[0], key) if has_more else None
+        next_cursor = getattr(rows[-1], key) if rows else None
+    else:
+        if after is not None:
+            query = query.filter(column > after)
+        rows = query.order_by(column).limit(size + 1).all()
+        has_more = len(rows) > size
+        rows = rows[:size]
+        next_cursor = getattr(rows[-1], key) if has_more else None
+        prev_cursor = getattr(rows[0], key) if after is not None and rows else None
+    return KeysetPage(rows, next_cursor, prev_cursor)
+
+
+@app.template_global()
+def page_url(**cursor):
+    args = {k: v for k, v in request.args.items() if k not in ("after", "before")}
+    args.update(cursor)
+    return url_for(request.endpoint, **args)
 
 
 @app.before_request
@@ -244,31 +2743,43 @@ def require_login():
 
 
 @app.route("/")
+@conditional(
+    "task",
+    "exchange_rate",
+    *[model.__tablename__ for model in DASHBOARD_COUNTS.values()],
+)
 def dashboard():
     q_task = request.args.get("q_task", "")
     q_deal = request.args.get("q_deal", "")
-    counts = {
-        "leads": Lead.query.count(),
-        "accounts": Account.query.count(),
-        "contacts": Contact.query.count(),
-        "deals": Deal.query.count(),
-        "products": Product.query.count(),
-        "pricebooks": Pricebook.query.count(),
-        "quotes": Quote.query.count(),
-    }
-    query = Task.query
+    limit = app.config["DASHBOARD_WIDGET_SIZE"]
+    query = Task.query.filter(
+        db.or_(
+            Task.status.is_(None),
+            Task.status.notin_(app.config["CLOSED_TASK_STATUSES"]),
+        )
+    )
     if q_task:
-        query = query.filter(Task.description.ilike(f"%{q_task}%"))
-    tasks = query.all()
+        query = search_filter(query, Task, Task.description, q_task)
+    # The task form stores a blank due date as "", which must sort last too.
+    due = db.func.nullif(Task.due_date, "")
+    tasks = query.order_by(due.is_(None), due).limit(limit).all()
 
-    deal_query = Deal.query
+    deal_query = Deal.query.filter(
+        db.or_(Deal.stage.is_(None), Deal.stage.notin_(app.config["CLOSED_DEAL_STAGES"]))
+    )
     if q_deal:
-        deal_query = deal_query.filter(Deal.name.ilike(f"%{q_deal}%"))
-    deals = deal_query.all()
+        deal_query = search_filter(deal_query, Deal, Deal.name, q_deal)
+    amount = converted_column(Deal)
+    deals = (
+        deal_query.options(with_converted(Deal))
+        .order_by(amount.is_(None), amount.desc())
+        .limit(limit)
+        .all()
+    )
 
     return render_template(
         "dashboard.html",
-        counts=counts,
+        counts=dashboard_counts(),
         tasks=tasks,
         deals=deals,
         q_task=q_task,
@@ -278,15 +2789,14 @@ def dashboard():
 
 
 @app.route("/leads")
+@conditional("lead")
 def list_leads():
     q = request.args.get("q", "")
-    query = Lead.query
-    if q:
-        query = query.filter(Lead.name.ilike(f"%{q}%"))
-    leads = query.all()
+    page = keyset_paginate(list_query("leads", q), Lead.id)
     return render_template(
         "leads.html",
-        leads=leads,
+        leads=page.items,
+        page=page,
         q=q,
         title=get_translations().get("leads", "Leads"),
     )
@@ -294,16 +2804,12 @@ def list_leads():
 
 @app.route("/leads/kanban")
 def leads_kanban():
-    statuses = [s.value for s in StatusOption.query.filter_by(model="lead").all()]
-    columns = {s: Lead.query.filter_by(status=s).all() for s in statuses}
-    return render_template(
-        "kanban.html", columns=columns, title="Leads Kanban", model="lead"
-    )
+    return render_kanban("lead", "Leads Kanban")
 
 
 @app.route("/leads/new")
 def new_lead():
-    statuses = StatusOption.query.filter_by(model="lead").all()
+    statuses = status_options("lead")
     return render_template("new_lead.html", statuses=statuses, title="New Lead")
 
 
@@ -324,28 +2830,15 @@ def create_lead():
 
 @app.route("/leads/<int:lead_id>")
 def show_lead(lead_id):
-    lead = Lead.query.get_or_404(lead_id)
-    tasks = Task.query.filter_by(model="leads", record_id=lead_id).all()
-    messages = (
-        Message.query.filter_by(model="leads", record_id=lead_id)
-        .order_by(Message.created_at.desc())
-        .all()
-    )
-    return render_template(
-        "lead_detail.html",
-        lead=lead,
-        tasks=tasks,
-        messages=messages,
-        model="leads",
-        record_id=lead_id,
-        title="Lead Detail",
+    return render_detail(
+        Lead, "leads", lead_id, "lead_detail.html", "lead", "Lead Detail"
     )
 
 
 @app.route("/leads/<int:lead_id>/edit")
 def edit_lead(lead_id):
     lead = Lead.query.get_or_404(lead_id)
-    statuses = StatusOption.query.filter_by(model="lead").all()
+    statuses = status_options("lead")
     return render_template(
         "edit_lead.html", lead=lead, statuses=statuses, title="Edit Lead"
     )
@@ -375,7 +2868,7 @@ def convert_lead(lead_id):
         notes=None,
     )
     db.session.add(account)
-    db.session.commit()
+    db.session.flush()
     contact = Contact(
         name=lead.name,
         email=lead.email,
@@ -389,15 +2882,14 @@ def convert_lead(lead_id):
 
 
 @app.route("/accounts")
+@conditional("account")
 def list_accounts():
     q = request.args.get("q", "")
-    query = Account.query
-    if q:
-        query = query.filter(Account.name.ilike(f"%{q}%"))
-    accounts = query.all()
+    page = keyset_paginate(list_query("accounts", q), Account.id)
     return render_template(
         "accounts.html",
-        accounts=accounts,
+        accounts=page.items,
+        page=page,
         q=q,
         title=get_translations().get("accounts", "Accounts"),
     )
@@ -425,21 +2917,8 @@ def create_account():
 
 @app.route("/accounts/<int:account_id>")
 def show_account(account_id):
-    account = Account.query.get_or_404(account_id)
-    tasks = Task.query.filter_by(model="accounts", record_id=account_id).all()
-    messages = (
-        Message.query.filter_by(model="accounts", record_id=account_id)
-        .order_by(Message.created_at.desc())
-        .all()
-    )
-    return render_template(
-        "account_detail.html",
-        account=account,
-        tasks=tasks,
-        messages=messages,
-        model="accounts",
-        record_id=account_id,
-        title="Account Detail",
+    return render_detail(
+        Account, "accounts", account_id, "account_detail.html", "account", "Account Detail"
     )
 
 
@@ -463,15 +2942,14 @@ def update_account(account_id):
 
 
 @app.route("/contacts")
+@conditional("contact")
 def list_contacts():
     q = request.args.get("q", "")
-    query = Contact.query
-    if q:
-        query = query.filter(Contact.name.ilike(f"%{q}%"))
-    contacts = query.all()
+    page = keyset_paginate(list_query("contacts", q), Contact.id)
     return render_template(
         "contacts.html",
-        contacts=contacts,
+        contacts=page.items,
+        page=page,
         q=q,
         title=get_translations().get("contacts", "Contacts"),
     )
@@ -479,8 +2957,7 @@ def list_contacts():
 
 @app.route("/contacts/new")
 def new_contact():
-    accounts = Account.query.all()
-    return render_template("new_contact.html", accounts=accounts, title="New Contact")
+    return render_template("new_contact.html", title="New Contact")
 
 
 @app.route("/contacts/create", methods=["POST"])
@@ -499,31 +2976,15 @@ def create_contact():
 
 @app.route("/contacts/<int:contact_id>")
 def show_contact(contact_id):
-    contact = Contact.query.get_or_404(contact_id)
-    tasks = Task.query.filter_by(model="contacts", record_id=contact_id).all()
-    messages = (
-        Message.query.filter_by(model="contacts", record_id=contact_id)
-        .order_by(Message.created_at.desc())
-        .all()
-    )
-    return render_template(
-        "contact_detail.html",
-        contact=contact,
-        tasks=tasks,
-        messages=messages,
-        model="contacts",
-        record_id=contact_id,
-        title="Contact Detail",
+    return render_detail(
+        Contact, "contacts", contact_id, "contact_detail.html", "contact", "Contact Detail"
     )
 
 
 @app.route("/contacts/<int:contact_id>/edit")
 def edit_contact(contact_id):
     contact = Contact.query.get_or_404(contact_id)
-    accounts = Account.query.all()
-    return render_template(
-        "edit_contact.html", contact=contact, accounts=accounts, title="Edit Contact"
-    )
+    return render_template("edit_contact.html", contact=contact, title="Edit Contact")
 
 
 @app.route("/contacts/<int:contact_id>/update", methods=["POST"])
@@ -539,15 +3000,14 @@ def update_contact(contact_id):
 
 
 @app.route("/deals")
+@conditional("deal")
 def list_deals():
     q = request.args.get("q", "")
-    query = Deal.query
-    if q:
-        query = query.filter(Deal.name.ilike(f"%{q}%"))
-    deals = query.all()
+    page = keyset_paginate(list_query("deals", q), Deal.id)
     return render_template(
         "deals.html",
-        deals=deals,
+        deals=page.items,
+        page=page,
         q=q,
         title=get_translations().get("deals", "Deals"),
     )
@@ -555,29 +3015,14 @@ def list_deals():
 
 @app.route("/deals/kanban")
 def deals_kanban():
-    statuses = [s.value for s in StatusOption.query.filter_by(model="deal").all()]
-    columns = {s: Deal.query.filter_by(stage=s).all() for s in statuses}
-    totals = {
-        s: db.session.query(db.func.coalesce(db.func.sum(Deal.amount), 0))
-        .filter_by(stage=s)
-        .scalar()
-        for s in statuses
-    }
-    return render_template(
-        "kanban.html",
-        columns=columns,
-        totals=totals,
-        title="Deals Kanban",
-        model="deal",
-    )
+    return render_kanban("deal", "Deals Kanban")
 
 
 @app.route("/deals/new")
 def new_deal():
-    accounts = Account.query.all()
-    stages = StatusOption.query.filter_by(model="deal").all()
+    stages = status_options("deal")
     return render_template(
-        "new_deal.html", accounts=accounts, stages=stages, title="New Deal"
+        "new_deal.html", stages=stages, title="New Deal"
     )
 
 
@@ -597,31 +3042,17 @@ def create_deal():
 
 @app.route("/deals/<int:deal_id>")
 def show_deal(deal_id):
-    deal = Deal.query.get_or_404(deal_id)
-    tasks = Task.query.filter_by(model="deals", record_id=deal_id).all()
-    messages = (
-        Message.query.filter_by(model="deals", record_id=deal_id)
-        .order_by(Message.created_at.desc())
-        .all()
-    )
-    return render_template(
-        "deal_detail.html",
-        deal=deal,
-        tasks=tasks,
-        messages=messages,
-        model="deals",
-        record_id=deal_id,
-        title="Deal Detail",
+    return render_detail(
+        Deal, "deals", deal_id, "deal_detail.html", "deal", "Deal Detail"
     )
 
 
 @app.route("/deals/<int:deal_id>/edit")
 def edit_deal(deal_id):
     deal = Deal.query.get_or_404(deal_id)
-    accounts = Account.query.all()
-    stages = StatusOption.query.filter_by(model="deal").all()
+    stages = status_options("deal")
     return render_template(
-        "edit_deal.html", deal=deal, accounts=accounts, stages=stages, title="Edit Deal"
+        "edit_deal.html", deal=deal, stages=stages, title="Edit Deal"
     )
 
 
@@ -638,15 +3069,14 @@ def update_deal(deal_id):
 
 
 @app.route("/products")
+@conditional("product")
 def list_products():
     q = request.args.get("q", "")
-    query = Product.query
-    if q:
-        query = query.filter(Product.name.ilike(f"%{q}%"))
-    products = query.all()
+    page = keyset_paginate(list_query("products", q), Product.id)
     return render_template(
         "products.html",
-        products=products,
+        products=page.items,
+        page=page,
         q=q,
         title=get_translations().get("products", "Products"),
     )
@@ -671,21 +3101,8 @@ def create_product():
 
 @app.route("/products/<int:product_id>")
 def show_product(product_id):
-    product = Product.query.get_or_404(product_id)
-    tasks = Task.query.filter_by(model="products", record_id=product_id).all()
-    messages = (
-        Message.query.filter_by(model="products", record_id=product_id)
-        .order_by(Message.created_at.desc())
-        .all()
-    )
-    return render_template(
-        "product_detail.html",
-        product=product,
-        tasks=tasks,
-        messages=messages,
-        model="products",
-        record_id=product_id,
-        title="Product Detail",
+    return render_detail(
+        Product, "products", product_id, "product_detail.html", "product", "Product Detail"
     )
 
 
@@ -706,15 +3123,14 @@ def update_product(product_id):
 
 
 @app.route("/pricebooks")
+@conditional("pricebook")
 def list_pricebooks():
     q = request.args.get("q", "")
-    query = Pricebook.query
-    if q:
-        query = query.filter(Pricebook.name.ilike(f"%{q}%"))
-    pricebooks = query.all()
+    page = keyset_paginate(list_query("pricebooks", q), Pricebook.id)
     return render_template(
         "pricebooks.html",
-        pricebooks=pricebooks,
+        pricebooks=page.items,
+        page=page,
         q=q,
         title=get_translations().get("pricebooks", "Pricebooks"),
     )
@@ -738,21 +3154,8 @@ def create_pricebook():
 
 @app.route("/pricebooks/<int:pricebook_id>")
 def show_pricebook(pricebook_id):
-    pricebook = Pricebook.query.get_or_404(pricebook_id)
-    tasks = Task.query.filter_by(model="pricebooks", record_id=pricebook_id).all()
-    messages = (
-        Message.query.filter_by(model="pricebooks", record_id=pricebook_id)
-        .order_by(Message.created_at.desc())
-        .all()
-    )
-    return render_template(
-        "pricebook_detail.html",
-        pricebook=pricebook,
-        tasks=tasks,
-        messages=messages,
-        model="pricebooks",
-        record_id=pricebook_id,
-        title="Pricebook Detail",
+    return render_detail(
+        Pricebook, "pricebooks", pricebook_id, "pricebook_detail.html", "pricebook", "Pricebook Detail"
     )
 
 
@@ -774,19 +3177,14 @@ def update_pricebook(pricebook_id):
 
 
 @app.route("/pricebook_entries")
+@conditional("price_book_entry", "product", "pricebook")
 def list_pricebook_entries():
     q = request.args.get("q", "")
-    query = PriceBookEntry.query
-    if q:
-        try:
-            entry_id = int(q)
-            query = query.filter(PriceBookEntry.id == entry_id)
-        except ValueError:
-            query = query.filter(PriceBookEntry.id == -1)
-    entries = query.all()
+    page = keyset_paginate(list_query("pricebook_entries", q), PriceBookEntry.id)
     return render_template(
         "pricebook_entries.html",
-        entries=entries,
+        entries=page.items,
+        page=page,
         q=q,
         title=get_translations().get("pricebook_entries", "Price Book Entries"),
     )
@@ -794,14 +3192,7 @@ def list_pricebook_entries():
 
 @app.route("/pricebook_entries/new")
 def new_pricebook_entry():
-    products = Product.query.all()
-    pricebooks = Pricebook.query.all()
-    return render_template(
-        "new_pricebook_entry.html",
-        products=products,
-        pricebooks=pricebooks,
-        title="New Price Book Entry",
-    )
+    return render_template("new_pricebook_entry.html", title="New Price Book Entry")
 
 
 @app.route("/pricebook_entries/create", methods=["POST"])
@@ -818,34 +3209,17 @@ def create_pricebook_entry():
 
 @app.route("/pricebook_entries/<int:entry_id>")
 def show_pricebook_entry(entry_id):
-    entry = PriceBookEntry.query.get_or_404(entry_id)
-    tasks = Task.query.filter_by(model="pricebook_entries", record_id=entry_id).all()
-    messages = (
-        Message.query.filter_by(model="pricebook_entries", record_id=entry_id)
-        .order_by(Message.created_at.desc())
-        .all()
-    )
-    return render_template(
-        "pricebook_entry_detail.html",
-        entry=entry,
-        tasks=tasks,
-        messages=messages,
-        model="pricebook_entries",
-        record_id=entry_id,
-        title="Price Book Entry Detail",
+    return render_detail(
+        PriceBookEntry, "pricebook_entries", entry_id, "pricebook_entry_detail.html", "entry", "Price Book Entry Detail"
     )
 
 
 @app.route("/pricebook_entries/<int:entry_id>/edit")
 def edit_pricebook_entry(entry_id):
     entry = PriceBookEntry.query.get_or_404(entry_id)
-    products = Product.query.all()
-    pricebooks = Pricebook.query.all()
     return render_template(
         "edit_pricebook_entry.html",
         entry=entry,
-        products=products,
-        pricebooks=pricebooks,
         title="Edit Price Book Entry",
     )
 
@@ -861,15 +3235,14 @@ def update_pricebook_entry(entry_id):
 
 
 @app.route("/quotes")
+@conditional("quote", "deal", "exchange_rate")
 def list_quotes():
     q = request.args.get("q", "")
-    query = Quote.query
-    if q:
-        query = query.filter(Quote.id == q)
-    quotes = query.all()
+    page = keyset_paginate(list_query("quotes", q).options(with_converted(Quote)), Quote.id)
     return render_template(
         "quotes.html",
-        quotes=quotes,
+        quotes=page.items,
+        page=page,
         q=q,
         title=get_translations().get("quotes", "Quotes"),
     )
@@ -877,15 +3250,14 @@ def list_quotes():
 
 @app.route("/quotes/new")
 def new_quote():
-    deals = Deal.query.all()
-    return render_template("new_quote.html", deals=deals, title="New Quote")
+    return render_template("new_quote.html", title="New Quote")
 
 
 @app.route("/quotes/create", methods=["POST"])
 def create_quote():
     quote = Quote(
         deal_id=request.form.get("deal_id"),
-        total=request.form.get("total"),
+        total=0,
         expiration_date=request.form.get("expiration_date"),
     )
     db.session.add(quote)
@@ -895,53 +3267,35 @@ def create_quote():
 
 @app.route("/quotes/<int:quote_id>")
 def show_quote(quote_id):
-    quote = Quote.query.get_or_404(quote_id)
-    tasks = Task.query.filter_by(model="quotes", record_id=quote_id).all()
-    messages = (
-        Message.query.filter_by(model="quotes", record_id=quote_id)
-        .order_by(Message.created_at.desc())
-        .all()
-    )
-    return render_template(
-        "quote_detail.html",
-        quote=quote,
-        tasks=tasks,
-        messages=messages,
-        model="quotes",
-        record_id=quote_id,
-        title="Quote Detail",
+    return render_detail(
+        Quote, "quotes", quote_id, "quote_detail.html", "quote", "Quote Detail"
     )
 
 
 @app.route("/quotes/<int:quote_id>/edit")
 def edit_quote(quote_id):
     quote = Quote.query.get_or_404(quote_id)
-    deals = Deal.query.all()
-    return render_template(
-        "edit_quote.html", quote=quote, deals=deals, title="Edit Quote"
-    )
+    return render_template("edit_quote.html", quote=quote, title="Edit Quote")
 
 
 @app.route("/quotes/<int:quote_id>/update", methods=["POST"])
 def update_quote(quote_id):
     quote = Quote.query.get_or_404(quote_id)
     quote.deal_id = request.form.get("deal_id")
-    quote.total = request.form.get("total")
     quote.expiration_date = request.form.get("expiration_date")
     db.session.commit()
     return redirect(url_for("show_quote", quote_id=quote.id))
 
 
 @app.route("/quote_line_items")
+@conditional("quote_line_item", "product")
 def list_quote_line_items():
     q = request.args.get("q", "")
-    query = QuoteLineItem.query
-    if q:
-        query = query.filter(QuoteLineItem.id == q)
-    items = query.all()
+    page = keyset_paginate(list_query("quote_line_items", q), QuoteLineItem.id)
     return render_template(
         "quote_line_items.html",
-        items=items,
+        items=page.items,
+        page=page,
         q=q,
         title=get_translations().get("quote_line_items", "Quote Line Items"),
     )
@@ -949,20 +3303,13 @@ def list_quote_line_items():
 
 @app.route("/quote_line_items/new")
 def new_quote_line_item():
-    quotes = Quote.query.all()
-    products = Product.query.all()
-    return render_template(
-        "new_quote_line_item.html",
-        quotes=quotes,
-        products=products,
-        title="New Quote Line Item",
-    )
+    return render_template("new_quote_line_item.html", title="New Quote Line Item")
 
 
 @app.route("/quote_line_items/create", methods=["POST"])
 def create_quote_line_item():
     item = QuoteLineItem(
-        quote_id=request.form.get("quote_id"),
+        quote_id=form_quote_id(),
         product_id=request.form.get("product_id"),
         quantity=request.form.get("quantity"),
         price=request.form.get("price"),
@@ -974,34 +3321,17 @@ def create_quote_line_item():
 
 @app.route("/quote_line_items/<int:item_id>")
 def show_quote_line_item(item_id):
-    item = QuoteLineItem.query.get_or_404(item_id)
-    tasks = Task.query.filter_by(model="quote_line_items", record_id=item_id).all()
-    messages = (
-        Message.query.filter_by(model="quote_line_items", record_id=item_id)
-        .order_by(Message.created_at.desc())
-        .all()
-    )
-    return render_template(
-        "quote_line_item_detail.html",
-        item=item,
-        tasks=tasks,
-        messages=messages,
-        model="quote_line_items",
-        record_id=item_id,
-        title="Quote Line Item Detail",
+    return render_detail(
+        QuoteLineItem, "quote_line_items", item_id, "quote_line_item_detail.html", "item", "Quote Line Item Detail"
     )
 
 
 @app.route("/quote_line_items/<int:item_id>/edit")
 def edit_quote_line_item(item_id):
     item = QuoteLineItem.query.get_or_404(item_id)
-    quotes = Quote.query.all()
-    products = Product.query.all()
     return render_template(
         "edit_quote_line_item.html",
         item=item,
-        quotes=quotes,
-        products=products,
         title="Edit Quote Line Item",
     )
 
@@ -1009,7 +3339,7 @@ def edit_quote_line_item(item_id):
 @app.route("/quote_line_items/<int:item_id>/update", methods=["POST"])
 def update_quote_line_item(item_id):
     item = QuoteLineItem.query.get_or_404(item_id)
-    item.quote_id = request.form.get("quote_id")
+    item.quote_id = form_quote_id()
     item.product_id = request.form.get("product_id")
     item.quantity = request.form.get("quantity")
     item.price = request.form.get("price")
@@ -1018,15 +3348,14 @@ def update_quote_line_item(item_id):
 
 
 @app.route("/tasks")
+@conditional("task")
 def list_tasks():
     q = request.args.get("q", "")
-    query = Task.query
-    if q:
-        query = query.filter(Task.description.ilike(f"%{q}%"))
-    tasks = query.all()
+    page = keyset_paginate(list_query("tasks", q), Task.id)
     return render_template(
         "tasks.html",
-        tasks=tasks,
+        tasks=page.items,
+        page=page,
         q=q,
         title=get_translations().get("tasks", "Tasks"),
     )
@@ -1034,16 +3363,12 @@ def list_tasks():
 
 @app.route("/tasks/kanban")
 def tasks_kanban():
-    statuses = [s.value for s in StatusOption.query.filter_by(model="task").all()]
-    columns = {s: Task.query.filter_by(status=s).all() for s in statuses}
-    return render_template(
-        "kanban.html", columns=columns, title="Tasks Kanban", model="task"
-    )
+    return render_kanban("task", "Tasks Kanban")
 
 
 @app.route("/tasks/new/<model>/<int:record_id>")
 def new_task(model, record_id):
-    statuses = StatusOption.query.filter_by(model="task").all()
+    statuses = status_options("task")
     return render_template(
         "new_task.html",
         model=model,
@@ -1080,29 +3405,24 @@ def create_message():
         content=content,
     )
     db.session.add(message)
-    db.session.commit()
-
-    mentioned = set(re.findall(r"@(\w+)", content))
-    for username in mentioned:
-        user = User.query.filter_by(username=username).first()
-        if user:
-            db.session.add(
-                Notification(
-                    user_id=user.id,
-                    message=message,
-                    model=model,
-                    record_id=record_id,
-                )
-            )
-    db.session.commit()
+    if app.config["NOTIFICATION_FANOUT"] == "inline":
+        db.session.flush()
+        fan_out_mentions([message])
+        db.session.commit()
+    else:
+        message.notified = not MENTION_RE.search(content)
+        if not message.notified:
+            enqueue_job("deliver_notifications")
+        db.session.commit()
     return redirect(record_url(model, record_id))
 
 
 @app.route("/notifications")
 @login_required
+@conditional("notification", "message", "user")
 def list_notifications():
     notes = (
-        Notification.query.filter_by(user_id=current_user.id)
+        view_query(Notification).filter_by(user_id=current_user.id)
         .order_by(Notification.created_at.desc())
         .all()
     )
@@ -1115,7 +3435,11 @@ def view_notification(notif_id):
     note = Notification.query.get_or_404(notif_id)
     if note.user_id != current_user.id:
         return redirect(url_for("list_notifications"))
-    note.is_read = True
+    if not note.is_read:
+        note.is_read = True
+        bump_unread_notifications([note.user_id], -1)
+        # Other open tabs of the same user drop the count too.
+        queue_event(db.session, "notification", {"delta": -1}, user_id=note.user_id)
     db.session.commit()
     return redirect(record_url(note.model, note.record_id))
 
@@ -1123,25 +3447,29 @@ def view_notification(notif_id):
 @app.route("/search")
 def global_search():
     q = request.args.get("q", "")
-    like = f"%{q}%"
-    results = {
-        "leads": [
-            (l.name, url_for("show_lead", lead_id=l.id))
-            for l in Lead.query.filter(Lead.name.ilike(like)).all()
-        ],
-        "accounts": [
-            (a.name, url_for("show_account", account_id=a.id))
-            for a in Account.query.filter(Account.name.ilike(like)).all()
-        ],
-        "contacts": [
-            (c.name, url_for("show_contact", contact_id=c.id))
-            for c in Contact.query.filter(Contact.name.ilike(like)).all()
-        ],
-        "deals": [
-            (d.name, url_for("show_deal", deal_id=d.id))
-            for d in Deal.query.filter(Deal.name.ilike(like)).all()
-        ],
-    }
+    limit = app.config["SEARCH_RESULT_LIMIT"]
+    if app.config["SEARCH_FTS"]:
+        results = search_records(q, limit)
+    else:
+        like = f"%{q}%"
+        results = {
+            "leads": [
+                (l.name, url_for("show_lead", lead_id=l.id))
+                for l in Lead.query.filter(Lead.name.ilike(like)).limit(limit)
+            ],
+            "accounts": [
+                (a.name, url_for("show_account", account_id=a.id))
+                for a in Account.query.filter(Account.name.ilike(like)).limit(limit)
+            ],
+            "contacts": [
+                (c.name, url_for("show_contact", contact_id=c.id))
+                for c in Contact.query.filter(Contact.name.ilike(like)).limit(limit)
+            ],
+            "deals": [
+                (d.name, url_for("show_deal", deal_id=d.id))
+                for d in Deal.query.filter(Deal.name.ilike(like)).limit(limit)
+            ],
+        }
     return render_template(
         "search_results.html", q=q, results=results, title=f"Search: {q}"
     )
@@ -1167,23 +3495,27 @@ def settings():
         country = request.form.get("country", "")
         currency = request.form.get("currency", "USD")
         if current_user.is_authenticated:
+            # current_user is a cached snapshot; change the row itself.
+            user = db.session.get(User, current_user.id)
             if lang in AVAILABLE_LANGS:
-                current_user.language = lang
+                user.language = lang
                 session["lang"] = lang
-            current_user.timezone = tz
-            current_user.country = country
+            user.timezone = tz
+            user.country = country
             if currency in ("USD", "EUR"):
-                current_user.currency = currency
+                user.currency = currency
             db.session.commit()
+            forget_identity(current_user.id)
         else:
             if lang in AVAILABLE_LANGS:
                 session["lang"] = lang
         return redirect(url_for("settings"))
     if current_user.is_authenticated:
-        current = current_user.language
-        tz = current_user.timezone
-        country = current_user.country or ""
-        currency = current_user.currency
+        user = db.session.get(User, current_user.id)
+        current = user.language
+        tz = user.timezone
+        country = user.country or ""
+        currency = user.currency
     else:
         current = session.get("lang", "en")
         tz = "UTC"
@@ -1219,6 +3551,69 @@ def admin_overview():
     )
 
 
+@app.route("/admin/profiling")
+@login_required
+def admin_profiling():
+    if not current_user.is_admin:
+        return redirect(url_for("dashboard"))
+    endpoints, queries = profile_summary()
+    return render_template(
+        "profiling.html",
+        endpoints=endpoints,
+        queries=queries,
+        cache_stats=sorted(cache.stats.items()),
+        cache_backend=type(cache.backend).__name__,
+        sample_rate=app.config["PROFILE_SAMPLE_RATE"],
+        title=get_translations().get("profiling", "Profiling"),
+    )
+
+
+@app.route("/admin/jobs")
+@login_required
+def admin_jobs():
+    if not current_user.is_admin:
+        return redirect(url_for("dashboard"))
+    depth, latency, oldest, jobs = job_summary()
+    return render_template(
+        "jobs.html",
+        depth=depth,
+        latency=latency,
+        oldest=oldest,
+        jobs=jobs,
+        maintenance_jobs=MAINTENANCE_JOBS,
+        now=datetime.utcnow(),
+        title=get_translations().get("jobs", "Background jobs"),
+    )
+
+
+@app.route("/admin/jobs/create", methods=["POST"])
+@login_required
+def create_job():
+    if not current_user.is_admin:
+        return redirect(url_for("dashboard"))
+    kind = request.form.get("kind")
+    if kind in MAINTENANCE_JOBS:
+        enqueue_job(kind)
+        db.session.commit()
+    return redirect(url_for("admin_jobs"))
+
+
+@app.route("/admin/jobs/<int:job_id>/retry", methods=["POST"])
+@login_required
+def retry_job(job_id):
+    if not current_user.is_admin:
+        return redirect(url_for("dashboard"))
+    job = Job.query.get_or_404(job_id)
+    if job.status == "failed":
+        job.status = "queued"
+        job.attempts = 0
+        job.run_at = datetime.utcnow()
+        job.finished_at = None
+        db.session.info["jobs_enqueued"] = True
+        db.session.commit()
+    return redirect(url_for("admin_jobs"))
+
+
 @app.route("/admin/users")
 @login_required
 def admin_users():
@@ -1249,6 +3644,8 @@ def create_user():
     )
     db.session.add(user)
     db.session.commit()
+    # SQLite can hand a deleted user's id to the next new one.
+    forget_identity(user.id)
     return redirect(url_for("admin_users"))
 
 
@@ -1260,9 +3657,99 @@ def delete_user(user_id):
     user = User.query.get_or_404(user_id)
     db.session.delete(user)
     db.session.commit()
+    forget_identity(user_id)
     return redirect(url_for("admin_users"))
 
 
+@app.route("/admin/imports")
+@login_required
+def admin_imports():
+    if not current_user.is_admin:
+        return redirect(url_for("dashboard"))
+    runs = ImportRun.query.order_by(ImportRun.id.desc()).limit(50).all()
+    return render_template(
+        "imports.html",
+        runs=runs,
+        kinds=list(IMPORT_SOURCES),
+        title=get_translations().get("imports", "Imports"),
+    )
+
+
+def _import_upload(run):
+    """Store the uploaded file for ``run`` and queue the import job.
+
+    Without a new upload, a resumed run reuses the file kept from its last
+    attempt.
+    """
+    upload = request.files.get("file")
+    path = import_upload_path(run)
+    if upload and upload.filename:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        upload.save(path)
+    elif not os.path.exists(path):
+        flash("Choose a file to import")
+        return None
+    run.status = "queued"
+    enqueue_job("import_records", run_id=run.id)
+    db.session.commit()
+    return run
+
+
+@app.route("/admin/imports/create", methods=["POST"])
+@login_required
+def create_import():
+    if not current_user.is_admin:
+        return redirect(url_for("dashboard"))
+    kind = request.form.get("kind")
+    upload = request.files.get("file")
+    if kind not in IMPORT_SOURCES or not upload or not upload.filename:
+        flash("Choose a record type and a file to import")
+        return redirect(url_for("admin_imports"))
+    fmt = request.form.get("format") or import_format(upload.filename)
+    run = ImportRun(
+        kind=kind,
+        filename=upload.filename,
+        format=fmt if fmt in IMPORT_FORMATS else "csv",
+        rows_done=0,
+        inserted=0,
+        failed=0,
+    )
+    db.session.add(run)
+    db.session.commit()
+    _import_upload(run)
+    return redirect(url_for("show_import", run_id=run.id))
+
+
+@app.route("/admin/imports/<int:run_id>")
+@login_required
+def show_import(run_id):
+    if not current_user.is_admin:
+        return redirect(url_for("dashboard"))
+    run = ImportRun.query.get_or_404(run_id)
+    errors = (
+        ImportRowError.query.filter_by(run_id=run.id)
+        .order_by(ImportRowError.row)
+        .limit(200)
+        .all()
+    )
+    return render_template(
+        "import_run.html", run=run, errors=errors, title=f"Import {run.id}"
+    )
+
+
+@app.route("/admin/imports/<int:run_id>/resume", methods=["POST"])
+@login_required
+def resume_import(run_id):
+    if not current_user.is_admin:
+        return redirect(url_for("dashboard"))
+    run = ImportRun.query.get_or_404(run_id)
+    if run.status in ("queued", "running"):
+        flash("This import is already in progress")
+    else:
+        _import_upload(run)
+    return redirect(url_for("show_import", run_id=run.id))
+
+
 @app.route("/admin/statuses")
 @login_required
 def manage_statuses():
@@ -1312,52 +3799,146 @@ def delete_status(status_id):
 
 @app.route("/api/update_status", methods=["POST"])
 def api_update_status():
-    data = request.get_json()
-    model = data.get("model")
-    record_id = data.get("id")
-    status = data.get("status")
-    if model == "lead":
-        record = Lead.query.get(record_id)
-        if record:
-            record.status = status
-    elif model == "deal":
-        record = Deal.query.get(record_id)
-        if record:
-            record.stage = status
-    elif model == "task":
-        record = Task.query.get(record_id)
-        if record:
-            record.status = status
-    else:
-        return {"success": False}, 400
+    data = request.get_json(silent=True) or {}
+    try:
+        apply_status_moves([data])
+    except ValueError as exc:
+        return {"success": False, "error": str(exc)}, 400
     db.session.commit()
     return {"success": True}
 
 
+@app.route("/events")
+@login_required
+def events():
+    """Stream live notification and kanban events to the signed-in user."""
+    q = event_broker.hub.subscribe(current_user.id)
+    event_broker.listen()
+    # The stream can stay open for hours; give its connection back now.
+    db.session.remove()
+    return Response(
+        event_stream(q),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/api/update_status/bulk", methods=["POST"])
+def api_update_status_bulk():
+    """Apply a batch of kanban moves in one transaction; all or nothing."""
+    data = request.get_json(silent=True) or {}
+    moves = data.get("moves")
+    if not isinstance(moves, list):
+        return {"success": False, "error": "moves must be a list"}, 400
+    try:
+        updated = apply_status_moves(moves)
+    except ValueError as exc:
+        return {"success": False, "error": str(exc)}, 400
+    db.session.commit()
+    return {"success": True, "updated": updated}
+
+
+@app.route("/api/pricing", methods=["POST"])
+def api_pricing():
+    """Price a cart of ``{"product_id", "quantity"}`` lines in one call."""
+    data = request.get_json(silent=True) or {}
+    lines = data.get("lines")
+    if not isinstance(lines, list):
+        return {"success": False, "error": "lines must be a list"}, 400
+    try:
+        priced, total = price_cart(data.get("pricebook_id"), lines)
+    except ValueError as exc:
+        return {"success": False, "error": str(exc)}, 400
+    return {"success": True, "lines": priced, "total": total}
+
+
+@app.route("/api/quotes/<int:quote_id>/line_items", methods=["POST"])
+def api_add_quote_line_items(quote_id):
+    """Price a cart and add it to a quote as line items in one flush."""
+    Quote.query.get_or_404(quote_id)
+    data = request.get_json(silent=True) or {}
+    lines = data.get("lines")
+    if not isinstance(lines, list):
+        return {"success": False, "error": "lines must be a list"}, 400
+    try:
+        priced, _ = price_cart(data.get("pricebook_id"), lines)
+    except ValueError as exc:
+        return {"success": False, "error": str(exc)}, 400
+    db.session.add_all(
+        QuoteLineItem(
+            quote_id=quote_id,
+            product_id=line["product_id"],
+            quantity=line["quantity"],
+            price=line["unit_price"],
+        )
+        for line in priced
+    )
+    db.session.commit()
+    return {"success": True, "added": len(priced), "total": db.session.get(Quote, quote_id).total}
+
+
+@app.route("/api/kanban/<board>")
+def api_kanban_cards(board):
+    """Return the next page of cards for one kanban column."""
+    if board not in KANBAN_BOARDS:
+        return {"error": "model"}, 404
+    model, status_attr, _ = KANBAN_BOARDS[board]
+    unchanged = not_modified(board, "exchange_rate")
+    if unchanged:
+        return unchanged
+    limit = app.config["KANBAN_COLUMN_SIZE"]
+    query = model.query.filter(getattr(model, status_attr) == request.args.get("status"))
+    if model in CONVERTED_AMOUNTS:
+        query = query.options(with_converted(model))
+    after = request.args.get("after", type=int)
+    if after is not None:
+        query = query.filter(model.id > after)
+    cards = query.order_by(model.id).limit(limit + 1).all()
+    next_cursor = cards[limit - 1].id if len(cards) > limit else None
+    return {
+        "html": render_template("kanban_cards.html", records=cards[:limit], model=board),
+        "next_cursor": next_cursor,
+    }
+
+
+RECORD_API_MODELS = {
+    model.__tablename__: model
+    for model in (Lead, Account, Contact, Deal, Product, Pricebook, Quote, Task)
+}
+
+
 @app.route("/api/record/<model>/<int:record_id>")
 def api_get_record(model, record_id):
-    if model == "lead":
-        record = Lead.query.get_or_404(record_id)
-    elif model == "account":
-        record = Account.query.get_or_404(record_id)
-    elif model == "contact":
-        record = Contact.query.get_or_404(record_id)
-    elif model == "deal":
-        record = Deal.query.get_or_404(record_id)
-    elif model == "product":
-        record = Product.query.get_or_404(record_id)
-    elif model == "pricebook":
-        record = Pricebook.query.get_or_404(record_id)
-    elif model == "quote":
-        record = Quote.query.get_or_404(record_id)
-    elif model == "task":
-        record = Task.query.get_or_404(record_id)
-    else:
+    if model not in RECORD_API_MODELS:
         return {"error": "model"}, 404
+    unchanged = not_modified(model)
+    if unchanged:
+        return unchanged
+    record = RECORD_API_MODELS[model].query.get_or_404(record_id)
     data = {k: v for k, v in record.__dict__.items() if k != "_sa_instance_state"}
     return data
 
 
+@app.route("/api/lookup/<table>")
+def api_lookup(table):
+    """Return a page of records matching a picker's typed prefix."""
+    if table not in LOOKUP_SOURCES:
+        abort(404)
+    unchanged = not_modified(table)
+    if unchanged:
+        return unchanged
+    q = request.args.get("q", "").strip()
+    after = request.args.get("after", type=int)
+    limit = request.args.get("limit", type=int)
+    results, next_cursor = cache.cached(
+        "lookup",
+        lambda: lookup_records(table, q, after, limit),
+        tags=[table],
+        key=f"{table}:{fold_name(q)}:{after}:{limit}",
+    )
+    return {"results": results, "next_cursor": next_cursor}
+
+
 @app.route("/api/users")
 @login_required
 def api_users():
@@ -1374,23 +3955,27 @@ def api_users():
 
 with app.app_context():
     db.create_all()
-    inspector = db.inspect(db.engine)
-    cols = {c['name'] for c in inspector.get_columns('user')}
-    added = False
-    if 'language' not in cols:
-        db.session.execute(db.text("ALTER TABLE user ADD COLUMN language VARCHAR(10) DEFAULT 'en'"))
-        added = True
-    if 'timezone' not in cols:
-        db.session.execute(db.text("ALTER TABLE user ADD COLUMN timezone VARCHAR(50) DEFAULT 'UTC'"))
-        added = True
-    if 'country' not in cols:
-        db.session.execute(db.text("ALTER TABLE user ADD COLUMN country VARCHAR(50)"))
-        added = True
-    if 'currency' not in cols:
-        db.session.execute(db.text("ALTER TABLE user ADD COLUMN currency VARCHAR(3) DEFAULT 'USD'"))
-        added = True
-    if added:
-        db.session.commit()
+    upgrade_schema()
+    ensure_table_versions()
+    for lang in AVAILABLE_LANGS:
+        get_catalog(lang)
+    if db.engine.dialect.name == "sqlite":
+        created = not db.inspect(db.engine).has_table("search_index")
+        try:
+            db.session.execute(
+                db.text(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+                    "title, body, kind UNINDEXED, model UNINDEXED, record_id UNINDEXED)"
+                )
+            )
+            db.session.commit()
+            app.config["SEARCH_FTS"] = True
+        except db.exc.OperationalError:
+            db.session.rollback()
+        else:
+            if created:
+                # Existing records predate the index; searches read only the index.
+                rebuild_search_index()
     if not User.query.filter_by(username="admin").first():
         admin_user = User(
             username="admin",
@@ -0,0 +1,105 @@
+"""Compare concurrent SQLite throughput with default and tuned pragmas.
+
+Starts writer and reader processes against a scratch copy of the CRM schema
+and reports operations per second and "database is locked" failures for
+SQLite's defaults and for the profile in ``app.config["SQLITE_PRAGMAS"]``.
+
+    python benchmarks/sqlite_concurrency.py --writers 4 --readers 4 --seconds 5
+"""
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def worker(path, pragmas, role, seconds, results):
+    # Same 5 second busy timeout the app's connections had before tuning.
+    conn = sqlite3.connect(path, timeout=5)
+    for name, value in pragmas.items():
+        if name != "journal_mode":
+            conn.execute(f"PRAGMA {name}={value}")
+    ops = locked = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            if role == "write":
+                conn.execute(
+                    "INSERT INTO lead (name, email, status) VALUES (?, ?, 'New')",
+                    (f"Bench {ops}", f"bench{ops}@example.com"),
+                )
+                conn.commit()
+            else:
+                conn.execute(
+                    "SELECT id, name FROM lead WHERE status = 'New' ORDER BY id DESC LIMIT 50"
+                ).fetchall()
+            ops += 1
+        except sqlite3.OperationalError as exc:
+            if "locked" not in str(exc):
+                raise
+            locked += 1
+            conn.rollback()
+    conn.close()
+    results.put((role, ops, locked))
+
+
+def run(path, pragmas, writers, readers, seconds):
+    results = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(target=worker, args=(path, pragmas, role, seconds, results))
+        for role in ["write"] * writers + ["read"] * readers
+    ]
+    for p in procs:
+        p.start()
+    totals = {"write": [0, 0], "read": [0, 0]}
+    for _ in procs:
+        role, ops, locked = results.get()
+        totals[role][0] += ops
+        totals[role][1] += locked
+    for p in procs:
+        p.join()
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'template.db')}"
+    import app as crm
+
+    profiles = [("default", {}), ("tuned", dict(crm.app.config["SQLITE_PRAGMAS"]))]
+    with crm.app.app_context():
+        crm.db.engine.dispose()
+
+    for name, pragmas in profiles:
+        path = os.path.join(workdir, f"{name}.db")
+        conn = sqlite3.connect(path)
+        conn.executescript(
+            "CREATE TABLE lead (id INTEGER PRIMARY KEY, name VARCHAR(120) NOT NULL,"
+            " email VARCHAR(120), phone VARCHAR(50), company VARCHAR(120), notes TEXT,"
+            " status VARCHAR(50));"
+            "CREATE INDEX ix_lead_status ON lead (status);"
+        )
+        # Set the (persistent) journal mode before the workers start racing.
+        if "journal_mode" in pragmas:
+            conn.execute(f"PRAGMA journal_mode={pragmas['journal_mode']}")
+        conn.close()
+        totals = run(path, pragmas, args.writers, args.readers, args.seconds)
+        print(f"{name:8s}", end="")
+        for role in ("write", "read"):
+            ops, locked = totals[role]
+            print(f"  {role}s/s {ops / args.seconds:10.0f} (locked {locked})", end="")
+        print()
+
+
+if __name__ == "__main__":
+    main()
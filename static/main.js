@@ -15,7 +15,7 @@ window.addEventListener('DOMContentLoaded', () => {
 
     // Drag & drop for kanban cards and detail popup
     let dragging = false;
-    document.querySelectorAll('.kanban-card').forEach(card => {
+    function bindCard(card) {
         card.addEventListener('dragstart', ev => {
             dragging = true;
             ev.dataTransfer.setData('text/plain', card.dataset.id);
@@ -44,7 +44,13 @@ window.addEventListener('DOMContentLoaded', () => {
                 offcanvas.show();
             });
         });
-    });
+    }
+    document.querySelectorAll('.kanban-card').forEach(bindCard);
+
+    function adjustCount(col, delta) {
+        const badge = col && col.querySelector('.kanban-count');
+        if (badge) badge.textContent = parseInt(badge.textContent, 10) + delta;
+    }
 
     document.querySelectorAll('.kanban-column').forEach(col => {
         col.addEventListener('dragover', ev => ev.preventDefault());
@@ -55,12 +61,71 @@ window.addEventListener('DOMContentLoaded', () => {
             const status = col.dataset.status;
             const card = document.querySelector(`.kanban-card[data-id='${id}'][data-model='${model}']`);
             if (card && status) {
+                const from = card.closest('.kanban-column');
+                if (from === col) return;
                 col.querySelector('.cards').appendChild(card);
-                fetch('/api/update_status', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ model, id, status })
-                });
+                adjustCount(from, -1);
+                adjustCount(col, 1);
+                queueMove(model, id, status);
+            }
+        });
+    });
+
+    // Drags are coalesced: moves made within a short pause are sent as one
+    // batch, and only the last column a card was dropped in counts.
+    const pendingMoves = new Map();
+    let moveTimer = null;
+
+    function queueMove(model, id, status) {
+        pendingMoves.set(`${model}:${id}`, { model, id, status });
+        clearTimeout(moveTimer);
+        moveTimer = setTimeout(flushMoves, 400);
+    }
+
+    function flushMoves() {
+        clearTimeout(moveTimer);
+        if (!pendingMoves.size) return;
+        const body = JSON.stringify({ moves: Array.from(pendingMoves.values()) });
+        pendingMoves.clear();
+        fetch('/api/update_status/bulk', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body,
+            keepalive: true
+        }).then(r => {
+            if (!r.ok) window.location.reload();
+        });
+    }
+
+    window.addEventListener('pagehide', flushMoves);
+
+    // Page further cards into a kanban column when it is scrolled to the end
+    function loadMoreCards(button) {
+        if (button.disabled) return;
+        button.disabled = true;
+        const params = new URLSearchParams({ status: button.dataset.status, after: button.dataset.after });
+        fetch(`/api/kanban/${button.dataset.model}?${params}`).then(r => r.json()).then(data => {
+            const cards = button.closest('.kanban-column').querySelector('.cards');
+            const holder = document.createElement('div');
+            holder.innerHTML = data.html;
+            holder.querySelectorAll('.kanban-card').forEach(card => {
+                bindCard(card);
+                cards.appendChild(card);
+            });
+            if (data.next_cursor === null) {
+                button.remove();
+            } else {
+                button.dataset.after = data.next_cursor;
+                button.disabled = false;
+            }
+        });
+    }
+    document.querySelectorAll('.kanban-more').forEach(button => {
+        button.addEventListener('click', () => loadMoreCards(button));
+        const cards = button.closest('.kanban-column').querySelector('.cards');
+        cards.addEventListener('scroll', () => {
+            if (cards.scrollTop + cards.clientHeight >= cards.scrollHeight - 50) {
+                loadMoreCards(button);
             }
         });
     });
@@ -124,6 +189,114 @@ window.addEventListener('DOMContentLoaded', () => {
         });
     }
 
+    function initLookup(input) {
+        const hidden = input.previousElementSibling;
+        const dropdown = document.createElement('div');
+        dropdown.className = 'mention-dropdown list-group position-absolute w-100';
+        dropdown.style.display = 'none';
+        input.parentNode.appendChild(dropdown);
+
+        let timer = null;
+        let request = 0;
+
+        function choose(result) {
+            hidden.value = result.id;
+            input.value = result.label;
+            dropdown.style.display = 'none';
+        }
+
+        function search(after) {
+            const params = new URLSearchParams({q: input.value});
+            if (after) {
+                params.set('after', after);
+            }
+            const current = ++request;
+            fetch(`/api/lookup/${input.dataset.lookup}?${params}`)
+                .then(r => r.json())
+                .then(data => {
+                    // Ignore responses that arrive after a newer search started.
+                    if (current !== request) {
+                        return;
+                    }
+                    if (!after) {
+                        dropdown.innerHTML = '';
+                    }
+                    const more = dropdown.querySelector('.lookup-more');
+                    if (more) {
+                        more.remove();
+                    }
+                    data.results.forEach(result => {
+                        const item = document.createElement('button');
+                        item.type = 'button';
+                        item.className = 'list-group-item list-group-item-action';
+                        item.textContent = result.label;
+                        item.addEventListener('mousedown', e => {
+                            e.preventDefault();
+                            choose(result);
+                        });
+                        dropdown.appendChild(item);
+                    });
+                    if (data.next_cursor !== null) {
+                        const item = document.createElement('button');
+                        item.type = 'button';
+                        item.className = 'list-group-item list-group-item-action lookup-more';
+                        item.textContent = '…';
+                        item.addEventListener('mousedown', e => {
+                            e.preventDefault();
+                            search(data.next_cursor);
+                        });
+                        dropdown.appendChild(item);
+                    }
+                    dropdown.style.display = dropdown.children.length ? 'block' : 'none';
+                });
+        }
+
+        input.addEventListener('input', () => {
+            hidden.value = '';
+            clearTimeout(timer);
+            timer = setTimeout(() => search(null), 250);
+        });
+        input.addEventListener('focus', () => {
+            if (!input.value) {
+                search(null);
+            }
+        });
+        input.addEventListener('blur', () => {
+            setTimeout(() => dropdown.style.display = 'none', 200);
+        });
+    }
+
+    document.querySelectorAll('.lookup-input').forEach(initLookup);
+
+    // Live updates: unread counts and kanban moves made by other viewers
+    if (document.body.dataset.events && window.EventSource) {
+        const source = new EventSource(document.body.dataset.events);
+
+        source.addEventListener('notification', ev => {
+            const counter = document.getElementById('notification-count');
+            if (!counter) return;
+            const count = Math.max(0, parseInt(counter.dataset.count || '0', 10) + JSON.parse(ev.data).delta);
+            counter.dataset.count = count;
+            counter.textContent = count ? `(${count})` : '';
+        });
+
+        source.addEventListener('status', ev => {
+            JSON.parse(ev.data).forEach(move => {
+                const card = document.querySelector(`.kanban-card[data-id='${move.id}'][data-model='${move.model}']`);
+                const col = document.querySelector(`.kanban-column[data-status='${CSS.escape(move.status)}']`);
+                if (!card || !col) return;
+                const from = card.closest('.kanban-column');
+                // Our own drags arrive here too, after the card already moved.
+                if (from === col) return;
+                col.querySelector('.cards').appendChild(card);
+                adjustCount(from, -1);
+                adjustCount(col, 1);
+            });
+        });
+
+        window.addEventListener('pagehide', () => source.close());
+    }
+
     if (!window.ClassicEditor) {
         document.querySelectorAll('textarea.mention-enabled').forEach(initMentions);
     }